@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import time as time_cls, timedelta
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCH_PATH)
+# benchmark of this checkout
+sys.path[:0] = [os.path.join(REPO_PATH, 'src'), BENCH_PATH]
+
+import bench_tasks
+
+from simwg import Options, WorkerManager
+from simwg.api import AsyncResult, SimwgTask, TaskBackendAdapter
+
+"""
+Benchmarks of hot paths against local redis-server or Django database
+(SQLite by default, PostgreSQL by --database):
+
+    enqueue   SimwgTask.run and run_many
+    claim     pop_task and pop_tasks of task backend
+    dispatch  tasks through WorkerManager (subprocess) and workers
+    periodic  get_tasks of periodic backend (config file or Django)
+
+Each suite sweeps queue depth, payload size and worker count,
+results are json with throughput (per second) and p50/p99 latency (ms):
+
+    python benchmarks/bench.py --backend redis --redis-port 6379 \\
+        --depths 100,1000 --payloads 0,65536 --workers 1,4 \\
+        --output bench-$(git rev-parse --short HEAD).json
+
+Warning: redis database --redis-db (15) and simwg tables are cleared.
+"""
+
+REDIS_BACKEND = 'simwg.RedisTaskBackend'
+DJANGO_BACKEND = (
+    'simwg.django_simwg.django_simwg_backend.task_src.OrmDjangoTaskBackend')
+DJANGO_PERIODIC_BACKEND = (
+    'simwg.django_simwg.django_simwg_backend.task_src.'
+    'OrmDjangoPeriodicTaskBackend')
+CONFIG_PERIODIC_BACKEND = 'simwg.ConfigFilePeriodicTaskBackend'
+DJANGO_APP = 'simwg.django_simwg.django_simwg_backend'
+SUITES = ('enqueue', 'claim', 'dispatch', 'periodic')
+# results are kept by backend until timeout
+TASK_TIMEOUT = 3600
+# seconds to start manager
+MANAGER_START_TIMEOUT = 60.0
+
+
+def percentile(values, percent):
+    result = None
+    if values:
+        ordered = sorted(values)
+        index = int(round(percent / 100.0 * (len(ordered) - 1)))
+        result = ordered[min(index, len(ordered) - 1)]
+    return result
+
+
+def summary(suite, params, latencies, seconds, count):
+    """
+    :param list latencies: seconds of each operation
+    :param float seconds: time of all operations
+    :param int count: tasks processed
+    :rtype: dict
+    """
+    p50 = percentile(latencies, 50)
+    p99 = percentile(latencies, 99)
+    return {
+        'suite': suite,
+        'params': params,
+        'count': count,
+        'seconds': seconds,
+        'throughput': count / seconds if seconds else None,
+        'p50_ms': None if p50 is None else p50 * 1000.0,
+        'p99_ms': None if p99 is None else p99 * 1000.0,
+    }
+
+
+def progress(message):
+    sys.stderr.write(u'{}\n'.format(message))
+    sys.stderr.flush()
+
+
+def git_commit():
+    try:
+        result = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=REPO_PATH,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        result = None
+    return result
+
+
+def setup_django(database, migrate=False):
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            INSTALLED_APPS=[DJANGO_APP],
+            DATABASES={'default': database},
+            USE_TZ=True)
+        import django
+        django.setup()
+
+    if migrate:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+
+
+def configure(conf, migrate=False):
+    """
+    Options of this process (and of manager subprocess).
+    :param dict conf: backend, options, database
+    """
+    if conf['backend'] == 'django':
+        setup_django(conf['database'], migrate)
+
+    options = Options()
+    options.update(**conf['options'])
+    return options
+
+
+def reset(conf):
+    """
+    Clear queue and results.
+    """
+    if conf['backend'] == 'django':
+        from simwg.django_simwg.django_simwg_backend.models import (
+            ManageCommandModel, PeriodicSlotModel, PeriodicTaskModel,
+            TaskModel)
+        for model in (
+                TaskModel,
+                PeriodicTaskModel,
+                PeriodicSlotModel,
+                ManageCommandModel):
+            model.objects.all().delete()
+    else:
+        import redis
+        redis.Redis(**conf['options']['backend']).flushdb()
+
+
+def new_backend():
+    options = Options()
+    return options.task_backend_cls(options)
+
+
+def payload_params(payload):
+    return {'payload': 'x' * payload}
+
+
+def bench_enqueue(conf, args):
+    result = []
+    task = SimwgTask(bench_tasks.noop, timeout=TASK_TIMEOUT)
+    for payload in args.payloads:
+        reset(conf)
+        params = payload_params(payload)
+        latencies = []
+        started = time.time()
+        for _ in xrange(args.samples):
+            call_started = time.time()
+            task.run(params)
+            latencies.append(time.time() - call_started)
+        result.append(summary(
+            'enqueue',
+            {'payload': payload},
+            latencies,
+            time.time() - started,
+            args.samples))
+
+        reset(conf)
+        latencies = []
+        started = time.time()
+        for _ in xrange(0, args.samples, args.batch):
+            call_started = time.time()
+            task.run_many([params] * args.batch, chunk_size=args.batch)
+            latencies.append(time.time() - call_started)
+        result.append(summary(
+            'enqueue_many',
+            {'payload': payload, 'batch': args.batch},
+            latencies,
+            time.time() - started,
+            len(latencies) * args.batch))
+    return result
+
+
+def bench_claim(conf, args):
+    result = []
+    task = SimwgTask(bench_tasks.noop, timeout=TASK_TIMEOUT)
+    backend = new_backend()
+    for depth in args.depths:
+        for payload in args.payloads:
+            for batch in (1, args.batch):
+                reset(conf)
+                task.run_many([payload_params(payload)] * depth)
+                latencies = []
+                count = 0
+                started = time.time()
+                # drained queue is not measured
+                while count < min(args.samples, depth):
+                    call_started = time.time()
+                    if batch == 1:
+                        claimed = filter(None, [backend.pop_task()])
+                    else:
+                        claimed = backend.pop_tasks(batch)
+                    latencies.append(time.time() - call_started)
+                    if not claimed:
+                        # queue is empty before samples
+                        break
+                    count += len(claimed)
+                result.append(summary(
+                    'claim' if batch == 1 else 'claim_many',
+                    {'depth': depth, 'payload': payload, 'batch': batch},
+                    latencies,
+                    time.time() - started,
+                    count))
+    return result
+
+
+def start_manager(conf, workers, log_file):
+    manager_conf = dict(conf)
+    manager_conf['options'] = dict(
+        conf['options'], workers=workers, **conf['manager'])
+    return subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            '--manager',
+            json.dumps(manager_conf)],
+        stdout=log_file,
+        stderr=subprocess.STDOUT)
+
+
+def stop_manager(process):
+    process.terminate()
+    deadline = time.time() + MANAGER_START_TIMEOUT
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def bench_dispatch(conf, args):
+    result = []
+    task = SimwgTask(bench_tasks.noop, timeout=TASK_TIMEOUT)
+    log_file = open(args.log, 'a')
+    for workers in args.workers:
+        for depth in args.depths:
+            for payload in args.payloads:
+                reset(conf)
+                manager = start_manager(conf, workers, log_file)
+                try:
+                    # manager is ready after first result
+                    task.run({}).get(MANAGER_START_TIMEOUT)
+                    started = time.time()
+                    handles = task.run_many(
+                        [payload_params(payload)] * depth)
+                    ready = AsyncResult.wait_many(
+                        handles, args.dispatch_timeout)
+                    seconds = time.time() - started
+                finally:
+                    stop_manager(manager)
+
+                latencies = [
+                    float(handle.task.result.content) - handle.task.created
+                    for handle in ready if handle.task.result.content]
+                item = summary(
+                    'dispatch',
+                    {'workers': workers, 'depth': depth, 'payload': payload},
+                    latencies,
+                    seconds,
+                    len(ready))
+                item.update(failed=depth - len(latencies))
+                result.append(item)
+    log_file.close()
+    return result
+
+
+def bench_periodic(conf, args):
+    result = []
+    options = Options()
+    backend = new_backend()
+    for depth in args.depths:
+        depth = min(depth, bench_tasks.PERIODIC_METHODS)
+        methods = [
+            'bench_tasks.periodic_{}'.format(index)
+            for index in xrange(depth)]
+        reset(conf)
+        if conf['backend'] == 'django':
+            from simwg.django_simwg.django_simwg_backend.models import (
+                PeriodicTaskModel)
+            PeriodicTaskModel.objects.bulk_create([
+                PeriodicTaskModel(
+                    method=method, period=1, start_time=time_cls(0, 0))
+                for method in methods])
+        else:
+            with open(options.periodic_task_backend_options['path'],
+                      'w') as config_file:
+                config_file.write('[everytime]\n')
+                for method in methods:
+                    config_file.write('{}=00:00 1\n'.format(method))
+
+        periodic = options.periodic_task_backend_cls(options)
+        periodic.set_main_backend(backend)
+        at = periodic.now()
+        latencies = []
+        count = 0
+        started = time.time()
+        # every method is due once a minute
+        for _ in xrange(args.periodic_calls):
+            call_started = time.time()
+            count += len(periodic.get_tasks(at=at))
+            latencies.append(time.time() - call_started)
+            at += timedelta(minutes=1)
+        result.append(summary(
+            'periodic',
+            {'depth': depth},
+            latencies,
+            time.time() - started,
+            count))
+    return result
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=u'Benchmarks of simwg hot paths.')
+    parser.add_argument(
+        '--backend', choices=('redis', 'django'), default='redis')
+    parser.add_argument(
+        '--suites',
+        default=','.join(SUITES),
+        help=u'comma separated: {}'.format(', '.join(SUITES)))
+    parser.add_argument(
+        '--depths', type=int_list, default=[100, 1000],
+        help=u'queue depths (periodic methods in periodic suite)')
+    parser.add_argument(
+        '--payloads', type=int_list, default=[0, 1024, 65536],
+        help=u'params payload sizes in bytes')
+    parser.add_argument(
+        '--workers', type=int_list, default=[1, 4, 8],
+        help=u'worker counts of dispatch suite')
+    parser.add_argument(
+        '--samples', type=int, default=1000,
+        help=u'measured tasks of enqueue and claim suites')
+    parser.add_argument(
+        '--batch', type=int, default=100,
+        help=u'tasks of one run_many or pop_tasks call')
+    parser.add_argument(
+        '--periodic-calls', type=int, default=20,
+        help=u'get_tasks calls of periodic suite')
+    parser.add_argument(
+        '--dispatch-timeout', type=float, default=600.0,
+        help=u'max seconds of one dispatch run')
+    parser.add_argument(
+        '--manager-options', type=json.loads, default={},
+        help=u'json of extra manager options, e.g. {"prefork": true}')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument(
+        '--redis-db', type=int, default=15, help=u'cleared database')
+    parser.add_argument(
+        '--database', type=json.loads, default=None,
+        help=u'json of Django DATABASES item (SQLite file by default)')
+    parser.add_argument(
+        '--log', default=os.devnull, help=u'manager output file')
+    parser.add_argument(
+        '--output', default=None, help=u'json file (stdout by default)')
+    parser.add_argument('--manager', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run_manager(conf):
+    """
+    Manager of dispatch suite (in subprocess).
+    """
+    options = configure(conf)
+    WorkerManager(options).start()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.manager:
+        return run_manager(json.loads(args.manager))
+
+    suites = [suite for suite in args.suites.split(',') if suite]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        progress(u'Unknown suites: {}'.format(', '.join(sorted(unknown))))
+        return 2
+
+    work_path = tempfile.mkdtemp(prefix='simwg_bench_')
+    conf = {
+        'backend': args.backend,
+        'database': args.database or {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(work_path, 'bench.sqlite3'),
+            # manager and benchmark write at once
+            'OPTIONS': {'timeout': 30},
+        },
+        'manager': args.manager_options,
+        'options': {
+            'periodic_backend': {
+                'path': os.path.join(work_path, 'periodic.ini')},
+        },
+    }
+    if args.backend == 'django':
+        conf['options'].update(
+            backend_cls=DJANGO_BACKEND,
+            periodic_backend_cls=DJANGO_PERIODIC_BACKEND,
+            backend={})
+    else:
+        conf['options'].update(
+            backend_cls=REDIS_BACKEND,
+            periodic_backend_cls=CONFIG_PERIODIC_BACKEND,
+            backend={
+                'host': args.redis_host,
+                'port': args.redis_port,
+                'db': args.redis_db})
+    # empty schedule of manager
+    open(conf['options']['periodic_backend']['path'], 'w').close()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'backend': args.backend,
+        'database': (
+            conf['database']['ENGINE']
+            if args.backend == 'django' else None),
+        'results': [],
+    }
+    try:
+        configure(conf, migrate=True)
+        # backend of api from this options
+        TaskBackendAdapter()._init()
+        for suite in suites:
+            progress(u'suite {}'.format(suite))
+            report['results'].extend(
+                globals()['bench_{}'.format(suite)](conf, args))
+        reset(conf)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(content)
+    else:
+        sys.stdout.write(content + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import time
+
+# methods of periodic benchmark (one schedule line of each)
+PERIODIC_METHODS = 10000
+
+
+def noop(logger=None, timeout=None, **params):
+    """
+    :return: time of call (for dispatch latency),
+        as string (only string result is kept)
+    """
+    return repr(time.time())
+
+
+for _index in xrange(PERIODIC_METHODS):
+    globals()['periodic_{}'.format(_index)] = noop
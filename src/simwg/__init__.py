@@ -8,5 +8,7 @@
 
 from .config import Options
 from .manager import WorkerManager
+from .sqlite_task_src import SqliteTaskBackend
 from .task_src import (
-    RedisTaskBackend, ConfigFilePeriodicTaskBackend)
+    RedisTaskBackend, RedisStreamTaskBackend,
+    ConfigFilePeriodicTaskBackend)
@@ -5,9 +5,13 @@
 
 '''
 
+import time
+
 from .common import MetaOnceObject
+from .registry import method_path
 from .config import Options
-from .task import TaskData, TaskPriorityEnum
+from .exceptions import TaskResultTimeout
+from .task import ExecutionModeEnum, TaskData, TaskPriorityEnum
 from .task_src import (
     BaseTaskBackend, ManageCommandEnum)
 
@@ -32,57 +36,170 @@ class TaskBackendAdapter(object):
     def new_task(self, task):
         self._init()
         if isinstance(task, TaskData):
-            self._task_src.update_task(task)
+            self._task_src.add_task(task)
+
+    def new_tasks(self, tasks):
+        self._init()
+        self._task_src.add_tasks([
+            task for task in tasks if isinstance(task, TaskData)])
+
+    def get_task(self, key):
+        self._init()
+        return self._task_src.get_task(key)
+
+    def wait_result(self, keys, timeout=None):
+        self._init()
+        return self._task_src.wait_result(keys, timeout)
+
+    def index_pending(self):
+        self._init()
+        return self._task_src.index_pending()
+
+    def set_manage_command(self, command, params, node=None):
+        self._init()
+        return self._task_src.set_manage_command(command, params, node)
+
+
+class AsyncResult(object):
+    """
+    Handle of sent task.
+    """
+
+    _key = None
+    _task = None
+
+    def __init__(self, key):
+        self._key = key
+
+    def __repr__(self):
+        return '<AsyncResult {}>'.format(self._key)
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def task(self):
+        """
+        finished task data (None if not ready)
+        """
+        return self._task
+
+    def ready(self):
+        if self._task is None:
+            task = TaskBackendAdapter().get_task(self._key)
+            if task and task.result:
+                self._task = task
+        return self._task is not None
 
-    def set_manage_command(self, command, params):
-        return self._task_src.set_manage_command(command, params)
+    def get(self, timeout=None):
+        """
+        Wait task result.
+        :param float timeout: max wait in seconds (None - forever)
+        :rtype: TaskResult
+        """
+        if not self.ready():
+            task_src = TaskBackendAdapter()
+            if task_src.wait_result([self._key], timeout) is not None:
+                self.ready()
+
+        if self._task is None:
+            raise TaskResultTimeout()
+        return self._task.result
+
+    @staticmethod
+    def wait_many(handles, timeout=None):
+        """
+        Wait results of all handles.
+        :param list handles: list of AsyncResult
+        :param float timeout: max wait in seconds (None - forever)
+        :rtype: list
+        :return: ready handles
+        """
+        task_src = TaskBackendAdapter()
+        waiting = dict(
+            (handle.key, handle)
+            for handle in handles if not handle.ready())
+        deadline = None if timeout is None else time.time() + timeout
+
+        while waiting:
+            wait_time = None
+            if deadline is not None:
+                wait_time = deadline - time.time()
+                if wait_time <= 0:
+                    break
+
+            key = task_src.wait_result(list(waiting), wait_time)
+            if key is None:
+                break
+            waiting.pop(key).ready()
+
+        return [handle for handle in handles if handle.task is not None]
 
 
 class SimwgTask(object):
 
+    DEFAULT_CHUNK_SIZE = 1000
+
     _method = None
     _timeout = None
     _priority = None
+    _mode = None
 
     def __init__(
             self,
             method,
             timeout=TaskData.DEFAULT_TIMEOUT,
-            priority=TaskPriorityEnum.NORMAL):
+            priority=TaskPriorityEnum.NORMAL,
+            mode=ExecutionModeEnum.PROCESS):
+        """
+        :param int mode: execution mode in manager (ExecutionModeEnum),
+            method_modes option of manager overrides it
+        """
 
         if callable(method):
             self._method = method
             self._timeout = timeout
             self._priority = priority
+            self._mode = ExecutionModeEnum.from_name(mode)
         else:
             raise TypeError('{} is callable?'.format(method))
 
-    def _send(self, params=None, delay=0, priority=None):
+    def _create_task(self, key, params=None, delay=0, priority=None):
         task_params = None
         if isinstance(params, dict):
             task_params = params
 
-        task_src = TaskBackendAdapter()
         if isinstance(priority, int):
             task_priority = priority
         else:
             task_priority = self._priority
 
-        key = task_src.new_task_key(
-            delay=delay,
-            priority=task_priority,
-            timeout=self._timeout)
-
-        task_src.new_task(TaskData(
+        return TaskData(
             key=key,
             tid=key,
             delay=delay,
             priority=task_priority,
-            method=u'{}.{}'.format(
-                self._method.__module__,
-                self._method.__name__),
+            method=method_path(self._method),
             params=task_params,
-            timeout=self._timeout))
+            timeout=self._timeout,
+            mode=self._mode,
+            created=time.time())
+
+    def _send(self, params=None, delay=0, priority=None):
+        task_src = TaskBackendAdapter()
+        if not isinstance(priority, int):
+            priority = self._priority
+
+        key = task_src.new_task_key(
+            delay=delay,
+            priority=priority,
+            timeout=self._timeout)
+
+        task_src.new_task(
+            self._create_task(
+                key, params, delay=delay, priority=priority))
+        return AsyncResult(key)
 
     def run(
             self,
@@ -90,24 +207,82 @@ class SimwgTask(object):
             async=True,
             delay=0,
             priority=None):
-        # TODO: priority soon
+        """
+        :rtype: AsyncResult
+        :return: handle of sent task (None if not async)
+        """
+        result = None
         if self._method:
             if not isinstance(params, dict):
                 raise TypeError('params is dict?')
 
             if async:
-                self._send(params, delay=delay, priority=priority)
+                result = self._send(params, delay=delay, priority=priority)
             else:
                 self._method(**params)
+        return result
+
+    def run_many(
+            self,
+            params_list,
+            delay=0,
+            priority=None,
+            chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Send many tasks of this method, one backend write per chunk.
+        :param params_list: iterable of params dicts
+        :param int chunk_size: tasks in one backend write
+        :rtype: list
+        :return: AsyncResult of each task
+        """
+        result = []
+        if self._method:
+            task_src = TaskBackendAdapter()
+            chunk = []
+            for params in params_list:
+                if not isinstance(params, dict):
+                    raise TypeError('params is dict?')
+
+                # key from backend on save
+                chunk.append(
+                    self._create_task(
+                        None, params, delay=delay, priority=priority))
+
+                if len(chunk) >= chunk_size:
+                    task_src.new_tasks(chunk)
+                    result.extend(AsyncResult(task.key) for task in chunk)
+                    chunk = []
+
+            if chunk:
+                task_src.new_tasks(chunk)
+                result.extend(AsyncResult(task.key) for task in chunk)
+        return result
+
+
+def index_pending_tasks():
+    """
+    One-off after upgrade: pending tasks written by old versions
+    are added to queue index of backend.
+    :rtype: int
+    :return: count of indexed tasks
+    """
+
+    task_src = TaskBackendAdapter()
+    return task_src.index_pending()
 
 
-def free_worker(worker_index):
+def free_worker(worker_index, node):
     """
     Free worker of pool in manager (if any problem)
     :param int worker_index: index of worker [1..max_index]
+    :param str node: manager node name (worker index is known
+                     in this node only)
+    :rtype: int
+    :return: count of target nodes
     """
 
     task_src = TaskBackendAdapter()
-    task_src.set_manage_command(
+    return task_src.set_manage_command(
         ManageCommandEnum.FAKE_FREE_WORKER,
-        {'worker': worker_index})
+        {'worker': worker_index},
+        node=node)
@@ -5,9 +5,13 @@
 
 '''
 
+import os
+import socket
+
 from .common import MetaOnceObject
 from .exceptions import NoConfig
 from .helpers import import_object
+from .serializer import Serializer
 
 """
 Set logger example:
@@ -41,13 +45,73 @@ class Options(object):
 
     DEFAULTS = {
         'workers': 4,
+        # autoscaling of process workers in min..max (off if max is 0)
+        'min_workers': 1,
+        'max_workers': 0,
+        # grow if ready tasks are more than depth
+        # or first task waits longer than seconds (0 - not used)
+        'scale_up_depth': 0,
+        'scale_up_wait': 0,
+        # grow if load average per cpu is less (0 - not used)
+        'scale_max_load': 1.0,
+        # shrink by one worker after idle seconds
+        'scale_idle_time': 60.0,
+        # seconds between autoscaling decisions
+        'scale_interval': 5.0,
         'logger': 'console',
+        # manager name for commands (host name and pid by default)
+        'node_name': '',
         'step_delay': 0.5,
+        # event: wait backend events and worker results,
+        # poll: sleep step_delay between steps
+        'wait_mode': 'event',
+        'wait_timeout': 5.0,
+        # long-lived worker processes instead of process per task
+        'prefork': False,
+        # recycle prefork worker after N tasks (0 - never)
+        'max_tasks_per_child': 0,
+        # recycle prefork worker after task if memory is over M MB
+        'max_memory_per_child': 0,
+        # stop task process if memory is over M MB (0 - no limit)
+        'memory_limit': 0,
+        # seconds from SIGTERM to SIGKILL of stopped task process
+        'kill_timeout': 5.0,
+        # params larger than threshold (bytes) go to workers
+        # over spool files (0 - off), path /dev/shm by default
+        'spool_threshold': 0,
+        'spool_path': '',
+        # manager threads for thread mode tasks (0 - off)
+        'thread_workers': 0,
+        # coroutine mode tasks at once in manager event loop (0 - off)
+        'coroutine_workers': 0,
+        # execution mode of methods:
+        # {'pkg.module.method': 'thread'} (process, thread, coroutine)
+        'method_modes': {
+        },
+        # task methods imported at start,
+        # only these methods are executed (any if empty)
+        'methods': [
+        ],
+        # metrics over http (port 0 - off) and in json stats file
+        'metrics_port': 0,
+        'metrics_host': '127.0.0.1',
+        'stats_file': '',
+        # seconds between samples of queue and workers
+        'metrics_interval': 10.0,
+        # cProfile of 1 of N tasks: {'pkg.module.method': N}
+        # and of other methods (profile_rate N, 0 - off),
+        # profiles are in profile_path (temp directory by default)
+        'profile_methods': {
+        },
+        'profile_rate': 0,
+        'profile_path': '',
         'delay_method': 'time.sleep',
         'backend': {
         },
         'periodic_backend': {
         },
+        # task data format: pickle, json, msgpack
+        'serializer': Serializer.DEFAULT,
         'backend_cls': 'simwg.RedisTaskBackend',
         'periodic_backend_cls': 'simwg.ConfigFilePeriodicTaskBackend',
     }
@@ -64,9 +128,10 @@ class Options(object):
     def _get_by_field(self, field, rtype=None, default=0):
         if not isinstance(self._content, dict):
             raise NoConfig()
-        values = (
-            self._content.get(field) or
-            self.DEFAULTS.get(field))
+        values = self._content.get(field)
+        if not(values or isinstance(values, (int, long, float))):
+            # not set or empty, zero and False are values
+            values = self.DEFAULTS.get(field)
         result = default if values is None else values
         if rtype:
             result = rtype(result)
@@ -76,6 +141,40 @@ class Options(object):
     def worker_count(self):
         return self._get_by_field('workers', int)
 
+    @property
+    def min_worker_count(self):
+        return self._get_by_field('min_workers', int)
+
+    @property
+    def max_worker_count(self):
+        return self._get_by_field('max_workers', int)
+
+    @property
+    def scale_up_depth(self):
+        return self._get_by_field('scale_up_depth', int)
+
+    @property
+    def scale_up_wait(self):
+        return self._get_by_field('scale_up_wait', float)
+
+    @property
+    def scale_max_load(self):
+        return self._get_by_field('scale_max_load', float)
+
+    @property
+    def scale_idle_time(self):
+        return self._get_by_field('scale_idle_time', float)
+
+    @property
+    def scale_interval(self):
+        return self._get_by_field('scale_interval', float)
+
+    @property
+    def node_name(self):
+        return (
+            self._get_by_field('node_name', str, '') or
+            u'{}-{}'.format(socket.gethostname(), os.getpid()))
+
     @property
     def logger_name(self):
         return self._get_by_field('logger', str, '')
@@ -84,6 +183,89 @@ class Options(object):
     def delay(self):
         return self._get_by_field('step_delay', float)
 
+    @property
+    def wait_mode(self):
+        return self._get_by_field('wait_mode', str, '')
+
+    @property
+    def wait_timeout(self):
+        # zero timeout - busy loop of backend waiter
+        return (
+            self._get_by_field('wait_timeout', float) or
+            self.DEFAULTS['wait_timeout'])
+
+    @property
+    def prefork(self):
+        return self._get_by_field('prefork', bool, False)
+
+    @property
+    def max_tasks_per_child(self):
+        return self._get_by_field('max_tasks_per_child', int)
+
+    @property
+    def max_memory_per_child(self):
+        return self._get_by_field('max_memory_per_child', int)
+
+    @property
+    def memory_limit(self):
+        return self._get_by_field('memory_limit', int)
+
+    @property
+    def kill_timeout(self):
+        return self._get_by_field('kill_timeout', float)
+
+    @property
+    def spool_threshold(self):
+        return self._get_by_field('spool_threshold', int)
+
+    @property
+    def spool_path(self):
+        return self._get_by_field('spool_path', str, '')
+
+    @property
+    def thread_worker_count(self):
+        return self._get_by_field('thread_workers', int)
+
+    @property
+    def coroutine_worker_count(self):
+        return self._get_by_field('coroutine_workers', int)
+
+    @property
+    def method_modes(self):
+        return self._get_by_field('method_modes', dict, None)
+
+    @property
+    def methods(self):
+        return self._get_by_field('methods', list, None)
+
+    @property
+    def metrics_port(self):
+        return self._get_by_field('metrics_port', int)
+
+    @property
+    def metrics_host(self):
+        return self._get_by_field('metrics_host', str, '')
+
+    @property
+    def stats_file(self):
+        return self._get_by_field('stats_file', str, '')
+
+    @property
+    def metrics_interval(self):
+        return self._get_by_field('metrics_interval', float)
+
+    @property
+    def profile_methods(self):
+        return self._get_by_field('profile_methods', dict, None)
+
+    @property
+    def profile_rate(self):
+        return self._get_by_field('profile_rate', int)
+
+    @property
+    def profile_path(self):
+        return self._get_by_field('profile_path', str, '')
+
     @property
     def task_backend_options(self):
         return self._get_by_field('backend', dict, None)
@@ -102,6 +284,10 @@ class Options(object):
         path = self._get_by_field('periodic_backend_cls', str, '')
         return import_object(path)
 
+    @property
+    def serializer(self):
+        return Serializer(self._get_by_field('serializer', str, ''))
+
     @property
     def delay_method_name(self):
         return self._get_by_field('delay_method', str, '')
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_simwg_backend', '0003_taskmodel_eta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeriodicSlotModel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('slot', models.CharField(max_length=32)),
+                ('node', models.CharField(default=b'', max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'simwg_periodic_slot',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='periodicslotmodel',
+            unique_together=set([('name', 'slot')]),
+        ),
+    ]
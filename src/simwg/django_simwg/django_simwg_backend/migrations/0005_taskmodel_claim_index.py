@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+PENDING_INDEX = 'simwg_task_pending_idx'
+
+
+def create_pending_index(apps, schema_editor):
+    # partial index of waiting tasks (status WAIT), older task first
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute(
+            'CREATE INDEX {} ON simwg_task '
+            '(priority DESC, created ASC) '
+            'WHERE status = 1 AND taken IS NULL'.format(PENDING_INDEX))
+
+
+def drop_pending_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute(
+            'DROP INDEX IF EXISTS {}'.format(PENDING_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_simwg_backend', '0004_periodicslotmodel'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='taskmodel',
+            index_together=set([('status', 'taken', 'priority', 'created')]),
+        ),
+        migrations.RunPython(create_pending_index, drop_pending_index),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+PENDING_INDEX = 'simwg_task_pending_idx'
+
+
+def restore_pending_index(apps, schema_editor):
+    # sqlite rebuilds table in AddField/RemoveField, index of 0005 is lost
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS {} ON simwg_task '
+            '(priority DESC, created ASC) '
+            'WHERE status = 1 AND taken IS NULL'.format(PENDING_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_simwg_backend', '0006_periodictaskmodel_updated'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_pending_index),
+        migrations.AddField(
+            model_name='taskmodel',
+            name='mode',
+            field=models.IntegerField(default=0, choices=[(b'PROCESS', 0), (b'THREAD', 1), (b'COROUTINE', 2)]),
+        ),
+        migrations.AddField(
+            model_name='periodictaskmodel',
+            name='mode',
+            field=models.IntegerField(default=0, choices=[(b'PROCESS', 0), (b'THREAD', 1), (b'COROUTINE', 2)]),
+        ),
+        migrations.RunPython(restore_pending_index, migrations.RunPython.noop),
+    ]
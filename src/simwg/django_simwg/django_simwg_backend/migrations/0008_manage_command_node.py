@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_simwg_backend', '0007_task_mode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManagerNodeModel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('node', models.CharField(unique=True, max_length=255)),
+                ('seen', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'db_table': 'simwg_manager_node',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='managecommandmodel',
+            name='node',
+            field=models.CharField(default=b'', max_length=255, db_index=True),
+        ),
+    ]
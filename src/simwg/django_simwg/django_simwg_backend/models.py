@@ -6,15 +6,56 @@ Created on 25 февр. 2015 г.
 
 '''
 
+import calendar
+import time
+from datetime import datetime
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 from simwg.api import TaskPriorityEnum
 from simwg.common import BaseEnum
-from simwg.task import TaskData, TaskTypeEnum
-try:
-    import cPickle as pickler
-except ImportError:
-    import pickle as pickler
+from simwg.config import Options
+from simwg.exceptions import NoConfig
+from simwg.serializer import Serializer
+from simwg.task import (
+    ExecutionModeEnum, TaskData, TaskResultStatus, TaskTypeEnum)
+
+
+def get_serializer():
+    """
+    serializer of service options (default if not configured)
+    """
+    try:
+        result = Options().serializer
+    except NoConfig:
+        result = Serializer()
+    return result
+
+
+def as_datetime(value):
+    """
+    timestamp from task data to model datetime
+    """
+    if isinstance(value, (int, long, float)):
+        value = datetime.fromtimestamp(
+            value, timezone.utc if settings.USE_TZ else None)
+    return value
+
+
+def as_timestamp(value):
+    """
+    model datetime to timestamp of task data
+    """
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.utc)
+            seconds = calendar.timegm(value.timetuple())
+        else:
+            seconds = time.mktime(value.timetuple())
+        value = seconds + value.microsecond / 1e6
+    return value
 
 
 class TaskStatusEnum(BaseEnum):
@@ -47,13 +88,17 @@ class BaseTaskModel(models.Model):
         default=TaskStatusEnum.NEW,
         choices=TaskStatusEnum.as_choices())
 
+    mode = models.IntegerField(
+        default=ExecutionModeEnum.PROCESS,
+        choices=ExecutionModeEnum.as_choices())
+
     class Meta:
         abstract = True
 
     @property
     def result(self):
         if self.result_content:
-            result = pickler.loads(self.result_content)
+            result = get_serializer().loads(self.result_content)
         else:
             result = None
         return result
@@ -61,14 +106,14 @@ class BaseTaskModel(models.Model):
     @result.setter
     def result(self, value):
         if value:
-            self.result_content = pickler.dumps(value)
+            self.result_content = get_serializer().dumps_text(value)
         else:
             self.result_content = ''
 
     @property
     def params(self):
         if self.params_content:
-            result = pickler.loads(self.params_content)
+            result = get_serializer().loads(self.params_content)
         else:
             result = None
         return result
@@ -76,18 +121,21 @@ class BaseTaskModel(models.Model):
     @params.setter
     def params(self, value):
         if value:
-            self.params_content = pickler.dumps(value)
+            self.params_content = get_serializer().dumps_text(value)
         else:
             self.params_content = ''
 
     def update_data(self, task):
         assert isinstance(task, TaskData)
         assert task.type in self.accept_types
-        self.params = task.params
+        self.method = task.method
+        self.params_content = (
+            task.encode_params(get_serializer().dumps_text) or '')
         self.result = task.result
         self.timeout = task.timeout
         self.priority = task.priority
         self.delay = task.delay
+        self.mode = task.mode
 
     def get_advanced_task_data(self):
         """
@@ -95,17 +143,24 @@ class BaseTaskModel(models.Model):
         """
         return {}
 
+    @property
+    def task_key(self):
+        return self.pk
+
     def create_task_data(self):
         assert bool(self.pk)
 
         task = TaskData(
-            key=self.pk,
-            tid=self.pk,
+            key=self.task_key,
+            tid=self.task_key,
             method=self.method,
-            params=self.params,
+            params_content=self.params_content or None,
+            result=self.result,
             priority=self.priority,
             delay=self.delay,
             timeout=self.timeout,
+            mode=self.mode,
+            created=as_timestamp(self.created),
             **self.get_advanced_task_data())
         return task
 
@@ -116,17 +171,34 @@ class TaskModel(BaseTaskModel):
     """
     accept_types = [TaskTypeEnum.RPC]
 
+    # key generated by client (TaskData before insert)
+    uid = models.CharField(
+        max_length=32, unique=True, null=True, default=None)
+    # delayed task can be taken after this time
+    eta = models.DateTimeField(null=True, default=None, db_index=True)
     taken = models.DateTimeField(null=True, default=None)
     returned = models.DateTimeField(null=True, default=None)
 
     class Meta:
         db_table = 'simwg_task'
         ordering = ['priority', 'created']
+        # claim query (partial index in migration if supported)
+        index_together = [('status', 'taken', 'priority', 'created')]
+
+    @property
+    def task_key(self):
+        return self.uid or self.pk
 
     def update_data(self, task):
         super(TaskModel, self).update_data(task)
-        self.taken = task.taken
-        self.returned = task.returned
+        self.uid = task.key
+        self.taken = as_datetime(task.taken)
+        self.returned = as_datetime(task.returned)
+        if task.result:
+            if task.result.status == TaskResultStatus.DONE:
+                self.status = TaskStatusEnum.DONE
+            else:
+                self.status = TaskStatusEnum.FALID
 
     def get_advanced_task_data(self):
         result = super(TaskModel, self).get_advanced_task_data()
@@ -145,6 +217,8 @@ class PeriodicTaskModel(BaseTaskModel):
     run_count = models.IntegerField(default=0)
     period = models.IntegerField(default=0)
     start_time = models.TimeField()
+    # changed by save (not by update of run fields), cache version
+    updated = models.DateTimeField(auto_now=True)
 
     class Meta:
         db_table = 'simwg_periodic_task'
@@ -155,15 +229,41 @@ class PeriodicTaskModel(BaseTaskModel):
         return self.period == 0
 
     def get_advanced_task_data(self):
-        result = super(TaskModel, self).get_advanced_task_data()
+        result = super(PeriodicTaskModel, self).get_advanced_task_data()
         result.update(
             taken=self.run_last,
             task_type=TaskTypeEnum.PERIODIC)
         return result
 
 
+class PeriodicSlotModel(models.Model):
+    """
+    Claimed runs of periodic tasks (one node runs one slot)
+    """
+    name = models.CharField(max_length=255)
+    slot = models.CharField(max_length=32)
+    node = models.CharField(max_length=255, default='')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'simwg_periodic_slot'
+        unique_together = [('name', 'slot')]
+
+
+class ManagerNodeModel(models.Model):
+    """
+    Running managers (targets of manage commands), seen - heartbeat
+    """
+    node = models.CharField(max_length=255, unique=True)
+    seen = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'simwg_manager_node'
+
+
 class ManageCommandModel(models.Model):
     created = models.DateTimeField(auto_now_add=True)
+    node = models.CharField(max_length=255, default='', db_index=True)
     name = models.TextField(default='')
     params_content = models.TextField(default='')
     taken = models.DateTimeField(null=True, default=None)
@@ -174,7 +274,7 @@ class ManageCommandModel(models.Model):
     @property
     def params(self):
         if self.params_content:
-            result = pickler.loads(self.params_content)
+            result = get_serializer().loads(self.params_content)
         else:
             result = None
         return result
@@ -182,6 +282,6 @@ class ManageCommandModel(models.Model):
     @params.setter
     def params(self, value):
         if value:
-            self.params_content = pickler.dumps(value)
+            self.params_content = get_serializer().dumps_text(value)
         else:
             self.params_content = ''
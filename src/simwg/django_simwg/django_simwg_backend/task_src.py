@@ -6,9 +6,15 @@ Created on 26 февр. 2015 г.
 
 '''
 
+import heapq
+import operator
+import time
 from datetime import datetime, timedelta
 
-from django.db.models import Q
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.timezone import now as datetime_now
 
 from simwg.task import TaskData
@@ -16,74 +22,239 @@ from simwg.task_src import (
     BaseTaskBackend, BasePeriodicTaskBackend)
 
 from .models import (
-    TaskModel, TaskStatusEnum, ManageCommandModel,
-    PeriodicTaskModel)
+    TaskModel, TaskStatusEnum, ManageCommandModel, ManagerNodeModel,
+    PeriodicTaskModel, PeriodicSlotModel, as_timestamp)
 
 
 class OrmDjangoTaskBackend(BaseTaskBackend):
 
+    schedules_delay = True
+
     def __init__(self, options):
         super(OrmDjangoTaskBackend, self).__init__(options)
 
     def new_task_key(self, **params):
-        record = TaskModel()
-        record.save()
-        return record.pk
+        # row is created with this key by add_task
+        return self._rand_line
+
+    @staticmethod
+    def _key_lookup(key):
+        if isinstance(key, basestring):
+            result = Q(uid=key)
+        else:
+            # record created before client keys
+            result = Q(pk=key)
+        return result
 
     def info(self):
         return 'Django ORM model {}'.format(TaskModel)
 
     def pop_task(self):
-        result = None
-        tasks = TaskModel.objects.filter(
+        tasks = self.pop_tasks(1)
+        return tasks[0] if tasks else None
+
+    # one statement claim, rows locked by other managers are skipped
+    _claim_sql = (
+        'UPDATE {table} SET status = %s, taken = %s '
+        'WHERE id IN ('
+        'SELECT id FROM {table} '
+        'WHERE status = %s AND taken IS NULL '
+        'AND (eta IS NULL OR eta <= %s) '
+        'ORDER BY priority DESC, created '
+        'LIMIT %s FOR UPDATE SKIP LOCKED) '
+        'RETURNING *')
+
+    def _claim_records(self, count, taken):
+        if connection.vendor == 'postgresql':
+            records = list(TaskModel.objects.raw(
+                self._claim_sql.format(table=TaskModel._meta.db_table),
+                [
+                    TaskStatusEnum.PROCESSING,
+                    taken,
+                    TaskStatusEnum.WAIT,
+                    taken,
+                    count,
+                ]))
+            # returning has no order
+            records.sort(
+                key=lambda record: (-record.priority, record.created))
+        else:
+            tasks = TaskModel.objects.filter(
+                Q(eta__isnull=True) | Q(eta__lte=taken),
+                taken__isnull=True,
+                status=TaskStatusEnum.WAIT).order_by(
+                    '-priority', 'created')
+
+            if getattr(
+                    connection.features,
+                    'has_select_for_update_skip_locked', False):
+                tasks = tasks.select_for_update(skip_locked=True)
+            else:
+                tasks = tasks.select_for_update()
+
+            records = list(tasks[:count])
+            if records:
+                TaskModel.objects.filter(
+                    pk__in=[record.pk for record in records]).update(
+                        status=TaskStatusEnum.PROCESSING,
+                        taken=taken)
+
+                for record in records:
+                    record.status = TaskStatusEnum.PROCESSING
+                    record.taken = taken
+        return records
+
+    def _ready_records(self, now):
+        return TaskModel.objects.filter(
+            Q(eta__isnull=True) | Q(eta__lte=now),
             taken__isnull=True,
-            status=TaskStatusEnum.WAIT).order_by(
-                '-priority', '-created').select_for_update()
+            status=TaskStatusEnum.WAIT)
+
+    def queue_stats(self):
+        now = datetime_now()
+        stats = self._ready_records(now).aggregate(
+                count=Count('id'),
+                first=Min(Coalesce('eta', 'created')))
+        wait = None
+        if stats['first'] is not None:
+            wait = max((now - stats['first']).total_seconds(), 0)
+        return stats['count'], wait
+
+    def queue_depths(self):
+        records = self._ready_records(datetime_now()).order_by().values(
+            'priority').annotate(count=Count('id'))
+        return dict(
+            (record['priority'], record['count']) for record in records)
+
+    def pop_tasks(self, count):
+        with transaction.atomic():
+            records = self._claim_records(count, datetime_now())
+        return [record.create_task_data() for record in records]
+
+    def release_tasks(self, tasks):
+        if tasks:
+            TaskModel.objects.filter(
+                reduce(operator.or_, [
+                    self._key_lookup(task.key) for task in tasks]),
+                status=TaskStatusEnum.PROCESSING).update(
+                    status=TaskStatusEnum.WAIT,
+                    taken=None)
+
+    def update_task(self, task):
+        assert isinstance(task, TaskData)
         try:
-            record = tasks[:1].get()
+            record = TaskModel.objects.get(self._key_lookup(task.key))
         except TaskModel.DoesNotExist:
-            result = None
+            self._logger.error(
+                'Does not exists record! id:{}'.format(task.key))
         else:
-            record.status = TaskStatusEnum.PROCESSING
-            record.taken = datetime_now()
+            record.update_data(task)
             record.save()
-            result = record.create_task_data()
 
+    def claim_slot(self, name, slot, ttl):
+        try:
+            with transaction.atomic():
+                PeriodicSlotModel.objects.create(
+                    name=name, slot=slot, node=self._node)
+        except IntegrityError:
+            result = False
+        else:
+            result = True
+            # old claims
+            PeriodicSlotModel.objects.filter(
+                name=name,
+                created__lt=datetime_now() - timedelta(
+                    seconds=int(ttl))).delete()
         return result
 
-    def update_task(self, task):
-        assert isinstance(task, TaskData)
+    def get_task(self, key):
         try:
-            record = TaskModel.objects.get(pk=task.key)
+            record = TaskModel.objects.get(self._key_lookup(key))
         except TaskModel.DoesNotExist:
-            self._logger.error(
-                'Does not exists record! id:{}'.format(task.key))
+            result = None
         else:
-            record.update_data(task)
+            result = record.create_task_data()
+        return result
 
-    def set_manage_command(self, command, params):
+    def _new_record(self, task):
+        assert isinstance(task, TaskData)
+        if task.key is None:
+            task.key = self.new_task_key(priority=task.priority)
+        record = TaskModel(status=TaskStatusEnum.WAIT)
+        record.update_data(task)
+        if task.delay:
+            record.eta = datetime_now() + timedelta(seconds=task.delay)
+        return record
+
+    def add_task(self, task):
+        # one INSERT
+        self._new_record(task).save(force_insert=True)
+
+    def add_tasks(self, tasks):
+        TaskModel.objects.bulk_create([
+            self._new_record(task) for task in tasks])
+
+    def register_node(self):
+        ManagerNodeModel.objects.update_or_create(
+            node=self._node, defaults={'seen': datetime_now()})
+
+    def unregister_node(self):
+        ManagerNodeModel.objects.filter(node=self._node).delete()
+
+    def set_manage_command(self, command, params, node=None):
+        # one record for each target node
         if not(params and isinstance(params, dict)):
             raise TypeError('params incorrect')
 
         if command and isinstance(command, basestring):
-            command = ManageCommandModel(name=command)
-            command.params = params
-            command.save()
+            self._check_command_node(command, node)
+            if node:
+                nodes = [node]
+            else:
+                ManagerNodeModel.objects.filter(
+                    seen__lt=datetime_now() - timedelta(
+                        seconds=self.node_ttl)).delete()
+                nodes = list(ManagerNodeModel.objects.values_list(
+                    'node', flat=True))
+
+            if not nodes:
+                self._logger.warning(
+                    'No alive manager node for command {}'.format(command))
+
+            records = []
+            for target in nodes:
+                record = ManageCommandModel(name=command, node=target)
+                record.params = params
+                records.append(record)
+            ManageCommandModel.objects.bulk_create(records)
         else:
             raise TypeError('command incorrect')
+        return len(nodes)
 
     def select_manage_command(self, command):
         result = {}
         if command and isinstance(command, basestring):
-            commands = ManageCommandModel.objects.filter(
-                taken__isnull=True,
-                name=command).order_by(
-                    '-created').select_for_update()
-
-            for record in commands:
+            with transaction.atomic():
+                commands = ManageCommandModel.objects.filter(
+                    taken__isnull=True,
+                    node=self._node,
+                    name=command).order_by('created')
+
+                if getattr(
+                        connection.features,
+                        'has_select_for_update_skip_locked', False):
+                    commands = commands.select_for_update(skip_locked=True)
+                else:
+                    commands = commands.select_for_update()
+
+                records = list(commands)
+                if records:
+                    ManageCommandModel.objects.filter(
+                        pk__in=[record.pk for record in records]).update(
+                            taken=datetime_now())
+
+            for record in records:
                 result[record.id] = record.params
-            commands.update(taken=datetime_now())
-
         else:
             raise TypeError('command incorrect')
         return result
@@ -91,53 +262,134 @@ class OrmDjangoTaskBackend(BaseTaskBackend):
 
 class OrmDjangoPeriodicTaskBackend(BasePeriodicTaskBackend):
     """
-    Django ORM backend for periodic tasks
+    Django ORM backend for periodic tasks,
+    definitions and next runs are cached in memory,
+    the table is read again only if it was changed.
     """
 
+    # seconds between checks of table version
+    check_interval = 1.0
+
+    _records = None
+    _heap = None
+    _version = None
+    _checked = None
+
+    def __init__(self, *args, **kwargs):
+        super(OrmDjangoPeriodicTaskBackend, self).__init__(*args, **kwargs)
+        self._records = {}
+        self._heap = []
+
     def info(self):
         return 'Django ORM model {}'.format(PeriodicTaskModel)
 
     def now(self):
         return datetime_now()
 
-    def calc_next_run(self):
+    def first_run(self, record, now):
+        """
+        first run of task without run_next (start time of today)
+        """
+        result = datetime.combine(now.date(), record.start_time)
+        if timezone.is_aware(now):
+            result = timezone.make_aware(
+                result, timezone.get_current_timezone())
+        return result
+
+    def _reset(self):
+        """
+        read table at next call
+        """
+        self._version = None
+        self._checked = None
+
+    def _sync(self, now):
+        check_time = time.time()
+        if self._checked and check_time - self._checked < self.check_interval:
+            return
+
+        self._checked = check_time
+        version = PeriodicTaskModel.objects.aggregate(
+            updated=Max('updated'), count=Count('id'))
+        version = (version['updated'], version['count'])
+        if version == self._version:
+            return
+
         records = PeriodicTaskModel.objects.filter(
-            run_next__isnull=True).select_related()
+            Q(period__gt=0) | Q(run_last__isnull=True))
 
-        now = self.now()
-        now_date = now.date()
+        self._records = {}
+        self._heap = []
         for record in records:
-            record.run_last = None
-            record.run_next = datetime.combine(
-                now_date, record.start_time)
-            record.save()
+            self._records[record.pk] = record
+            self._heap.append(
+                (record.run_next or self.first_run(record, now), record.pk))
+
+        heapq.heapify(self._heap)
+        self._version = version
+
+    def _fire(self, record, run_next, run_at):
+        """
+        Conditional update of run fields,
+        only one node updates the record for this run.
+        :rtype: bool
+        """
+        if record.once:
+            next_run = run_next
+        else:
+            next_run = run_at + timedelta(seconds=60 * record.period)
 
-    def get_tasks(self, at=None, one=False):
-        assert isinstance(self._main_backend, BaseTaskBackend)
-        self.calc_next_run()
+        records = PeriodicTaskModel.objects.filter(pk=record.pk)
+        if record.run_next is None:
+            records = records.filter(run_next__isnull=True)
+        else:
+            records = records.filter(run_next=record.run_next)
+        if record.once:
+            records = records.filter(run_last__isnull=True)
 
-        run_at = self.now()
+        fired = records.update(
+            run_last=run_at,
+            run_next=next_run,
+            run_count=F('run_count') + 1) == 1
 
-        records = PeriodicTaskModel.objects.filter(
-            Q(period__gt=0) | (Q(period=0) & Q(run_last__isnull=True)),
-            run_next__gte=run_at).order_by(
-                'run_next').select_related()
+        if fired:
+            record.run_last = run_at
+            record.run_next = next_run
+            record.run_count = int(record.run_count or 0) + 1
+        return fired
+
+    def get_tasks(self, at=None, one=False, count=None, accept=None):
+        assert isinstance(self._main_backend, BaseTaskBackend)
+        run_at = at or self.now()
+        self._sync(run_at)
 
         result = []
-        for record in records:
-            record.run_last = run_at
-            run_count = int(record.run_count or 0) + 1
+        skipped = []
+        while self._heap and self._heap[0][0] <= run_at:
+            run_next, pk = heapq.heappop(self._heap)
+            record = self._records.get(pk)
+            if record is None:
+                continue
+
+            if accept and not accept(record.create_task_data()):
+                skipped.append((run_next, pk))
+                continue
+
+            if not self._fire(record, run_next, run_at):
+                # changed or fired by other node
+                self._reset()
+                continue
 
             if not record.once:
-                record.run_next = (
-                    run_at + timedelta(seconsd=60 * record.period))
-            record.run_count = run_count
-            record.save()
-            result.append(record.create_task_data())
+                heapq.heappush(self._heap, (record.run_next, pk))
 
-            if one:
+            result.append(record.create_task_data())
+            if one or (count and len(result) >= count):
                 break
 
+        for item in skipped:
+            heapq.heappush(self._heap, item)
+
         if one:
             try:
                 result = result[0]
@@ -148,3 +400,9 @@ class OrmDjangoPeriodicTaskBackend(BasePeriodicTaskBackend):
 
     def pop_task(self):
         return self.get_tasks(one=True)
+
+    def next_run(self):
+        result = None
+        if self._heap:
+            result = as_timestamp(self._heap[0][0])
+        return result
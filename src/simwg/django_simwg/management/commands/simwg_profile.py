@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+from django.conf import settings
+from django.core.management.base import (
+    BaseCommand, CommandError)
+from optparse import make_option
+
+
+SETTINGS_FIELD = 'SIMWG_SETTINGS'
+
+
+class Command(BaseCommand):
+
+    args = '<simwg_profile --method pkg.module.method>'
+    help = u'Hot spots of profiled simwg tasks'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--path',
+            dest='path',
+            default=None,
+            help=u'Profile directory (profile_path of options).'),
+        make_option(
+            '--method',
+            dest='method',
+            default=None,
+            help=u'Only this method.'),
+        make_option(
+            '--sort',
+            dest='sort',
+            default='cumulative',
+            help=u'pstats sort key.'),
+        make_option(
+            '--limit',
+            dest='limit',
+            type='int',
+            default=20,
+            help=u'Lines of each method.'),
+    )
+
+    def handle(self, *args, **options):
+        path = options.get('path')
+        if not path:
+            conf = getattr(settings, SETTINGS_FIELD, None) or {}
+            path = (conf.get('options') or {}).get('profile_path')
+
+        from simwg.profiling import report
+        # pstats writes parts of lines
+        self.stdout.ending = ''
+        try:
+            profiles = report(
+                path,
+                method=options.get('method'),
+                sort=options.get('sort'),
+                limit=options.get('limit'),
+                stream=self.stdout)
+        except (IOError, OSError) as err:
+            raise CommandError(err)
+
+        if not profiles:
+            raise CommandError(u'No one profile!')
@@ -49,11 +49,15 @@ class Command(BaseCommand):
             raise CommandError(u'Section "options" not found!')
 
         from simwg import WorkerManager, Options
+        from simwg.exceptions import ConfigError
         options_simwg = Options()
         options_simwg.update(**options)
 
-        manager = WorkerManager(
-            options=options_simwg,
-            methods=methods)
+        try:
+            manager = WorkerManager(
+                options=options_simwg,
+                methods=methods)
+        except ConfigError as err:
+            raise CommandError(err)
 
         manager.start()
@@ -10,3 +10,17 @@ class NoConfig(Exception):
 
     def __init__(self, msg='Set configuration!'):
         super(NoConfig, self).__init__(msg)
+
+
+class SerializeError(ValueError):
+    pass
+
+
+class TaskResultTimeout(Exception):
+
+    def __init__(self, msg='Task result is not ready!'):
+        super(TaskResultTimeout, self).__init__(msg)
+
+
+class ConfigError(Exception):
+    pass
@@ -6,6 +6,9 @@
 '''
 
 import importlib
+import os
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
 
 
 def import_object(line):
@@ -18,3 +21,17 @@ def import_object(line):
         module = importlib.import_module(u'.'.join(parts[:-1]))
         result = getattr(module, parts[-1], None)
     return result
+
+
+def process_rss(pid):
+    """
+    Resident memory of process in bytes (linux /proc).
+    :rtype: int
+    :return: 0 if unknown
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            result = int(statm.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, ValueError, IndexError):
+        result = 0
+    return result
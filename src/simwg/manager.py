@@ -5,101 +5,594 @@
 
 '''
 
+import errno
 import logging
-import inspect
 import gc
+import os
 import signal
 import time
 
-from Queue import Empty as QueueEmpty
-from multiprocessing import Process, Queue
+from Queue import Empty as QueueEmpty, Queue as ThreadQueue
+from functools import partial
+from multiprocessing import Pipe, Process, Queue, cpu_count
 from random import SystemRandom
+from threading import Thread
 
 from . import msg as this_msg
 from .config import Options
-from .helpers import import_object
-from .task import TaskResultStatus, TaskTypeEnum
+from .exceptions import ConfigError
+from .registry import MethodRegistry
+from .spool import ParamsSpool
+from .helpers import process_rss
+from .metrics import ManagerMetrics, MetricsServer
+from .profiling import TaskProfiler
+from .task import (
+    ExecutionModeEnum, TaskResultStatus, TaskTypeEnum, WorkerEventEnum)
 from .task_src import (
     BaseTaskBackend, ManageCommandEnum,
-    BasePeriodicTaskBackend)
-from .worker import process_worker
+    BasePeriodicTaskBackend, WakeEventEnum)
+from .worker import (
+    coroutine_support, done_result, execute_task, failed_result,
+    new_event_loop, prefork_worker, prepare_task, process_worker,
+    set_event_loop, start_coroutine)
 
 
 class WorkerPool(object):
+    """
+    Worker slots of all execution modes,
+    free slots of each mode in own set.
+    Index of slot is not changed, removed slot is inactive.
+    """
+
     _workers = None
+    _free = None
     _random = None
 
-    def __init__(self, size):
+    def __init__(self, size, thread_size=0, coroutine_size=0):
         self._random = SystemRandom()
-        n = int(size or 0)
-        if n:
-            self._workers = []
-            for i in range(size or 0):
-                self._workers.append({
-                    'busy': False,
-                    'name': i + 1,
-                })
-
-    def get_free(self, random=True):
-        free_index = [
-            index
-            for index, worker_data in enumerate(self._workers)
-            if not worker_data.get('busy')
-        ]
+        self._workers = []
+        self._free = {}
+        for mode, mode_size in (
+                (ExecutionModeEnum.PROCESS, size),
+                (ExecutionModeEnum.THREAD, thread_size),
+                (ExecutionModeEnum.COROUTINE, coroutine_size)):
+            self._free[mode] = set()
+            for _ in xrange(int(mode_size or 0)):
+                self.add(mode)
+
+    def add(self, mode=ExecutionModeEnum.PROCESS):
+        """
+        New free slot (inactive slot again if any).
+        :rtype: int
+        :return: slot index
+        """
+        result = None
+        for index, worker_data in enumerate(self._workers):
+            if (worker_data.get('mode') == mode and
+                    not worker_data.get('active')):
+                result = index
+                worker_data.update(active=True, busy=False)
+                break
+
+        if result is None:
+            result = len(self._workers)
+            self._workers.append({
+                'busy': False,
+                'active': True,
+                'name': result + 1,
+                'mode': mode,
+            })
+        self._free[mode].add(result)
+        return result
 
+    def remove(self, mode=ExecutionModeEnum.PROCESS):
+        """
+        Deactivate one free slot (last one).
+        :rtype: int or None
+        :return: slot index
+        """
+        free_index = self._free.get(mode)
         if free_index:
-            if random:
-                result = self._random.choice(free_index)
-            else:
-                result = free_index[0]
+            result = max(free_index)
+            free_index.discard(result)
+            self._workers[result].update(active=False)
         else:
             result = None
+        return result
+
+    def get_free(self, random=True, mode=None):
+        """
+        :param int mode: slot of this mode only (any if None)
+        """
+        result = None
+        if mode is None:
+            modes = (
+                ExecutionModeEnum.PROCESS,
+                ExecutionModeEnum.THREAD,
+                ExecutionModeEnum.COROUTINE)
+        else:
+            modes = (mode,)
+
+        for slot_mode in modes:
+            free_index = self._free.get(slot_mode)
+            if not free_index:
+                continue
+
+            if slot_mode != ExecutionModeEnum.PROCESS:
+                # threads and coroutines are equal
+                result = next(iter(free_index))
+            elif random:
+                result = self._random.choice(tuple(free_index))
+            else:
+                result = min(free_index)
+            break
 
         return result
 
-    def count_free(self):
+    def count_free(self, mode=None):
+        if mode is None:
+            result = sum(
+                len(free_index) for free_index in self._free.values())
+        else:
+            result = len(self._free.get(mode) or ())
+        return result
+
+    def size(self, mode):
         result = 0
         for worker_data in self._workers:
-            if not worker_data.get('busy'):
+            if (worker_data.get('mode') == mode and
+                    worker_data.get('active')):
                 result += 1
         return result
 
+    def mode(self, index):
+        return self._workers[index].get('mode')
+
     def is_all_free(self):
-        statuses = [
-            not worker_data.get('busy')
-            for worker_data in self._workers]
-        return len(statuses) < 1 or all(statuses)
+        active = [
+            worker_data
+            for worker_data in self._workers
+            if worker_data.get('active')]
+        return self.count_free() == len(active)
 
     def free(self, index):
-        self._workers[index].update(busy=False)
+        worker_data = self._workers[index]
+        worker_data.update(busy=False)
+        self._free[worker_data.get('mode')].add(index)
 
     def busy(self, index):
-        self._workers[index].update(busy=True)
+        worker_data = self._workers[index]
+        worker_data.update(busy=True)
+        self._free[worker_data.get('mode')].discard(index)
+
+
+class PreforkWorkers(object):
+    """
+    Long-lived worker processes, one for each worker pool index.
+    """
+
+    _processes = None
+    _result_queue = None
+    _delay_method_name = None
+    _logger_name = None
+    _max_tasks = 0
+    _registry = None
+
+    def __init__(
+            self,
+            result_queue,
+            delay_method_name,
+            logger_name,
+            max_tasks=0,
+            registry=None):
+
+        self._processes = {}
+        self._result_queue = result_queue
+        self._delay_method_name = delay_method_name
+        self._logger_name = logger_name
+        self._max_tasks = int(max_tasks or 0)
+        self._registry = registry
+
+    def _spawn(self, index):
+        reader, writer = Pipe(duplex=False)
+        worker = Process(
+            target=prefork_worker,
+            name='worker_{}'.format(index + 1),
+            kwargs={
+                'index': index,
+                'result_queue': self._result_queue,
+                'task_pipe': reader,
+                'delay_method': self._delay_method_name,
+                'logger_name': self._logger_name,
+                'max_tasks': self._max_tasks,
+                'registry': self._registry,
+            })
+        worker.start()
+        reader.close()
+        # process, pipe, sent tasks
+        self._processes[index] = [worker, writer, 0]
+
+    def _close(self, index):
+        worker, writer, _ = self._processes.pop(index)
+        try:
+            writer.send(None)
+        except (IOError, OSError):
+            # already dead
+            pass
+        writer.close()
+        worker.join()
+
+    def send(self, index, descriptor):
+        """
+        Run task in worker process of this index.
+        :param int index: worker index
+        :param dict descriptor: task data for prefork_worker
+        """
+
+        worker_data = self._processes.get(index)
+        if worker_data:
+            worker, _, count = worker_data
+            if not worker.is_alive() or (
+                    self._max_tasks and count >= self._max_tasks):
+                # recycle
+                self._close(index)
+
+        if index not in self._processes:
+            self._spawn(index)
+
+        worker_data = self._processes[index]
+        worker_data[1].send(descriptor)
+        worker_data[2] += 1
+
+    def process(self, index):
+        worker_data = self._processes.get(index)
+        return worker_data[0] if worker_data else None
+
+    def done(self, index, max_memory=0):
+        """
+        Recycle worker after task if limits are reached.
+        :param int index: worker index
+        :param int max_memory: memory limit in bytes (0 - no limit)
+        :rtype: str or None
+        :return: recycle reason (WorkerEventEnum)
+        """
+        result = None
+        worker_data = self._processes.get(index)
+        if worker_data:
+            worker, _, count = worker_data
+            if self._max_tasks and count >= self._max_tasks:
+                result = WorkerEventEnum.MAX_TASKS
+            elif max_memory and process_rss(worker.pid) > max_memory:
+                result = WorkerEventEnum.MAX_MEMORY
+
+        if result:
+            self._close(index)
+        return result
+
+    def close(self, index):
+        """
+        Stop worker process of removed slot.
+        """
+        if index in self._processes:
+            self._close(index)
+
+    def terminate(self, index):
+        """
+        Detach worker process of stopped task (new one on next send).
+        :rtype: Process or None
+        """
+        worker_data = self._processes.pop(index, None)
+        if worker_data:
+            worker, writer, _ = worker_data
+            writer.close()
+            result = worker
+        else:
+            result = None
+        return result
+
+    def stop(self):
+        for index in list(self._processes):
+            self._close(index)
+
+
+class ThreadWorkers(object):
+    """
+    Manager threads for thread mode tasks.
+    """
+
+    _threads = None
+    _tasks = None
+    _result_queue = None
+    _delay_method_name = None
+    _logger_name = None
+    _registry = None
+
+    def __init__(
+            self,
+            size,
+            result_queue,
+            delay_method_name,
+            logger_name,
+            registry=None):
+
+        self._tasks = ThreadQueue()
+        self._result_queue = result_queue
+        self._delay_method_name = delay_method_name
+        self._logger_name = logger_name
+        self._registry = registry
+        self._threads = []
+        for i in xrange(size):
+            thread = Thread(
+                target=self._work,
+                name='simwg_thread_{}'.format(i + 1))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                break
+
+            index, descriptor = item
+            task = descriptor.get('task')
+            result = execute_task(
+                index=index,
+                task=task,
+                method=descriptor.get('method'),
+                params=descriptor.get('params'),
+                delay=descriptor.get('delay'),
+                delay_method=self._delay_method_name,
+                logger_name=self._logger_name,
+                timeout=descriptor.get('timeout'),
+                params_content=descriptor.get('params_content'),
+                params_handle=descriptor.get('params_handle'),
+                method_id=descriptor.get('method_id'),
+                registry=self._registry,
+                profile_path=descriptor.get('profile_path'))
+
+            self._result_queue.put((task, index, result))
+
+    def send(self, index, descriptor):
+        self._tasks.put((index, descriptor))
+
+    def stop(self):
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class CoroutineWorkers(Thread):
+    """
+    Event loop for coroutine mode tasks in manager process.
+    """
+
+    _loop = None
+    _result_queue = None
+    _logger = None
+    _registry = None
+    _futures = None
+
+    def __init__(self, result_queue, logger_name, registry=None):
+        super(CoroutineWorkers, self).__init__(name='simwg_event_loop')
+        self.daemon = True
+        self._futures = {}
+        self._loop = new_event_loop()
+        self._result_queue = result_queue
+        self._logger = logging.getLogger(logger_name)
+        self._registry = registry
+
+    def run(self):
+        set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def send(self, index, descriptor):
+        self._loop.call_soon_threadsafe(self._start, index, descriptor)
+
+    def _start(self, index, descriptor):
+        delay = descriptor.get('delay')
+        if delay:
+            self._logger.info(
+                this_msg.task_delay_wait.format(
+                    descriptor.get('task'), index + 1, delay))
+            self._futures[index] = self._loop.call_later(
+                delay, self._execute, index, descriptor)
+        else:
+            self._execute(index, descriptor)
+
+    def cancel(self, index):
+        """
+        Cancel task of worker index (from manager thread).
+        """
+        self._loop.call_soon_threadsafe(self._cancel, index)
+
+    def _cancel(self, index):
+        future = self._futures.pop(index, None)
+        if future is not None:
+            future.cancel()
+
+    def _execute(self, index, descriptor):
+        task = descriptor.get('task')
+        error_msg = this_msg.task_run_error_tpl.format(task, index + 1)
+        try:
+            target_method, params = prepare_task(
+                descriptor.get('method'),
+                descriptor.get('params'),
+                self._logger,
+                descriptor.get('timeout'),
+                params_content=descriptor.get('params_content'),
+                params_handle=descriptor.get('params_handle'),
+                method_id=descriptor.get('method_id'),
+                registry=self._registry)
+            future = start_coroutine(self._loop, target_method, params)
+        except Exception as err:
+            self._result_queue.put(
+                (task, index, failed_result(err, self._logger, error_msg)))
+        else:
+            self._futures[index] = future
+            future.add_done_callback(
+                partial(self._done, task, index, error_msg))
+
+    def _done(self, task, index, error_msg, future):
+        if self._futures.get(index) is future:
+            del self._futures[index]
+        try:
+            result = done_result(future.result())
+        except BaseException as err:
+            # cancelled by manager too
+            result = failed_result(err, self._logger, error_msg)
+        self._result_queue.put((task, index, result))
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.join()
+        self._loop.close()
+
+
+class BackendWaiter(Thread):
+    """
+    Waits backend events and wakes manager over result queue.
+    """
+
+    _task_src = None
+    _wake_queue = None
+    _timeout = None
+    _logger = None
+    _is_work = False
+
+    def __init__(self, task_src, wake_queue, timeout, logger):
+        super(BackendWaiter, self).__init__(name='simwg_backend_waiter')
+        self.daemon = True
+        self._task_src = task_src
+        self._wake_queue = wake_queue
+        self._timeout = timeout
+        self._logger = logger
+
+    def run(self):
+        self._is_work = True
+        while self._is_work:
+            try:
+                events = self._task_src.wait_event(self._timeout)
+            except Exception as err:
+                self._logger.error(this_msg.wait_event_error.format(err))
+                # backend unavailable, do not spin
+                time.sleep(self._timeout)
+                events = None
+
+            if events and self._is_work:
+                for event in events:
+                    self._wake_queue.put(event)
+
+    def stop(self):
+        self._is_work = False
+        if self.is_alive():
+            # wait_event returns after timeout
+            self.join(self._timeout)
 
 
 class WorkerManager(object):
 
+    MIN_WAIT_TIME = 0.01
+    MEMORY_CHECK_INTERVAL = 1.0
+    # node heartbeat, less than node_ttl of backend
+    NODE_HEARTBEAT_INTERVAL = 30.0
+    MEGABYTE = 1024 * 1024
+
     _logger = None
     _workers = None
     _is_work = False
     _delay_method = None
     _delay_method_name = None
     _delay = 0
+    _wait_timeout = 0
+    _event_mode = False
+    _waiter = None
+    _spool = None
+    _prefork = None
+    _prefork_mode = False
+    _prefork_max_tasks = 0
+    _threads = None
+    _coroutines = None
+    _method_modes = None
     _task_src = None
     _periodic_task_src = None
     _result_tasks_queue = None
+    # free workers when tasks were returned to backend
+    _free_on_release = None
     _worker_task_data = None
-    _main_frame_id = None
-    _methods_cache = None
+    _main_pid = None
+    _registry = None
+    # running tasks: worker index -> process, deadline
+    _running = None
+    # stopped processes: [process, kill time]
+    _dying = None
+    # thread slots of stopped tasks, busy until thread returns
+    _stopped_threads = None
+    _memory_limit = 0
+    _max_memory = 0
+    _memory_checked = 0
+    _node_seen = 0
+    _kill_timeout = 0
+    _autoscale = False
+    _min_workers = 0
+    _max_workers = 0
+    _scale_up_depth = 0
+    _scale_up_wait = 0
+    _scale_max_load = 0
+    _scale_idle_time = 0
+    _scale_interval = 0
+    _scaled_at = 0
+    _idle_since = None
+    _metrics = None
+    _metrics_server = None
+    _metrics_port = 0
+    _metrics_host = None
+    _metrics_interval = 0
+    _sampled_at = 0
+    _stats_file = None
+    _profiler = None
 
-    def __init__(self, options):
+    def __init__(self, options, methods=None):
         """
         :param Options options: configuration object
+        :param list methods: task methods (full paths or functions),
+            imported and checked here, other methods are not executed
+            (methods option if None, any method if empty)
         """
 
         assert isinstance(options, Options)
         self._logger = logging.getLogger(options.logger_name)
-        self._workers = WorkerPool(options.worker_count)
+        worker_count = options.worker_count
+        self._max_workers = options.max_worker_count
+        self._autoscale = self._max_workers > 0
+        if self._autoscale:
+            self._min_workers = min(
+                options.min_worker_count, self._max_workers)
+            worker_count = max(
+                min(worker_count, self._max_workers), self._min_workers)
+            self._scale_up_depth = options.scale_up_depth
+            self._scale_up_wait = options.scale_up_wait
+            self._scale_max_load = options.scale_max_load
+            self._scale_idle_time = options.scale_idle_time
+            self._scale_interval = options.scale_interval
+
+        self._workers = WorkerPool(
+            worker_count,
+            options.thread_worker_count,
+            options.coroutine_worker_count)
+        if (self._workers.size(ExecutionModeEnum.COROUTINE) and
+                not coroutine_support()):
+            raise ConfigError(this_msg.no_coroutine_support)
+
+        try:
+            self._method_modes = dict(
+                (method, ExecutionModeEnum.from_name(mode))
+                for method, mode in (options.method_modes or {}).iteritems())
+        except ValueError as err:
+            raise ConfigError(err)
+
         self._delay = options.delay
         self._delay_method = options.delay_method
         self._delay_method_name = options.delay_method_name
@@ -111,7 +604,40 @@ class WorkerManager(object):
         assert issubclass(periodic_task_cls, BasePeriodicTaskBackend)
         self._periodic_task_src = periodic_task_cls(options)
         self._periodic_task_src.set_main_backend(self._task_src)
-        self._methods_cache = {}
+        if methods is None:
+            methods = options.methods
+        self._registry = MethodRegistry(methods)
+        self._logger.info(this_msg.registered_methods.format(
+            len(self._registry)))
+        self._wait_timeout = options.wait_timeout
+        self._event_mode = bool(
+            options.wait_mode == 'event' and self._task_src.can_wait)
+        self._prefork_mode = options.prefork
+        if options.spool_threshold:
+            self._spool = ParamsSpool(
+                options.spool_path, options.spool_threshold)
+        self._prefork_max_tasks = options.max_tasks_per_child
+        self._max_memory = options.max_memory_per_child * self.MEGABYTE
+        self._memory_limit = options.memory_limit * self.MEGABYTE
+        self._kill_timeout = options.kill_timeout
+        self._running = {}
+        self._dying = []
+        self._stopped_threads = set()
+        self._metrics = ManagerMetrics()
+        self._metrics_port = options.metrics_port
+        self._metrics_host = options.metrics_host
+        self._metrics_interval = options.metrics_interval
+        self._stats_file = options.stats_file
+        if options.profile_methods or options.profile_rate:
+            self._profiler = TaskProfiler(
+                options.profile_path,
+                options.profile_methods,
+                options.profile_rate)
+            self._logger.info(
+                this_msg.profile_path.format(self._profiler.path))
+        self._logger.info(
+            this_msg.wait_mode.format(
+                'event' if self._event_mode else 'poll'))
 
         self._worker_task_data = {}
         info_msg_tpl = (
@@ -126,8 +652,8 @@ class WorkerManager(object):
                 self._periodic_task_src.info()))
 
         def signal_term_handler(signal, frame):
-            if self._is_work and self._main_frame_id == id(frame):
-                # in main frame
+            if self._is_work and self._main_pid == os.getpid():
+                # in manager process
                 self._is_work = False
                 self._logger.info(this_msg.stopping)
 
@@ -137,14 +663,94 @@ class WorkerManager(object):
     def start(self):
         if not self._is_work:
             self._is_work = True
+            self._main_pid = os.getpid()
             self._result_tasks_queue = Queue()
-            self._run()
+            if self._prefork_mode:
+                self._prefork = PreforkWorkers(
+                    self._result_tasks_queue,
+                    self._delay_method_name,
+                    self._logger.name,
+                    self._prefork_max_tasks,
+                    self._registry)
+            thread_count = self._workers.size(ExecutionModeEnum.THREAD)
+            if thread_count:
+                self._threads = ThreadWorkers(
+                    thread_count,
+                    self._result_tasks_queue,
+                    self._delay_method_name,
+                    self._logger.name,
+                    self._registry)
+            if self._workers.size(ExecutionModeEnum.COROUTINE):
+                self._coroutines = CoroutineWorkers(
+                    self._result_tasks_queue,
+                    self._logger.name,
+                    self._registry)
+                self._coroutines.start()
+            if self._event_mode:
+                self._waiter = BackendWaiter(
+                    self._task_src,
+                    self._result_tasks_queue,
+                    self._wait_timeout,
+                    self._logger)
+                self._waiter.start()
+            if self._metrics_port:
+                self._metrics_server = MetricsServer(
+                    self._metrics,
+                    self._metrics_port,
+                    self._metrics_host)
+                self._metrics_server.start()
+                self._logger.info(
+                    this_msg.metrics_server.format(
+                        self._metrics_host, self._metrics_port))
+            self._heartbeat()
+            try:
+                self._run()
+            finally:
+                self._task_src.unregister_node()
+                if self._metrics_server:
+                    self._metrics_server.stop()
+                if self._waiter:
+                    self._waiter.stop()
+                if self._prefork:
+                    self._prefork.stop()
+                self._reap(force=True)
+                if self._threads:
+                    self._threads.stop()
+                if self._coroutines:
+                    self._coroutines.stop()
+                if self._spool:
+                    self._spool.clear()
+
+    def _receive(self, timeout=None):
+        """
+        Worker results and backend events from result queue.
+        :param float timeout: wait first item (no wait if empty)
+        """
+        items = []
+        block = bool(timeout)
+        while True:
+            try:
+                item = self._result_tasks_queue.get(
+                    block=block, timeout=timeout)
+            except QueueEmpty:
+                break
+            except (IOError, OSError) as err:
+                # signal in wait
+                if err.errno == errno.EINTR:
+                    break
+                raise
+
+            items.append(item)
+            block = False
+        return items
 
     def _run(self):
-        self._main_frame_id = id(inspect.currentframe())
         is_work = self._is_work
         delay_method = self._delay_method
         last_free_indexes = set()
+        queue_items = []
+        # commands sent before start
+        check_commands = True
 
         while is_work:
             is_work = not(
@@ -154,39 +760,61 @@ class WorkerManager(object):
                 # free any one
                 last_free_indexes.clear()
 
-                free_task_data = True
-
-                while free_task_data:
-                    try:
-                        free_task_data = self._result_tasks_queue.get(
-                            block=False)
-                    except QueueEmpty:
-                        free_task_data = False
-
-                    if free_task_data:
-                        task_key, worker_index, result = free_task_data
-
-                        task = self._worker_task_data[worker_index]
-                        # set result
-                        if task.key == task_key:
-                            last_free_indexes.add(worker_index)
-                            task.result = result
-                            task.returned = time.time()
-                            if task.type == TaskTypeEnum.RPC:
-                                self._task_src.update_task(task)
-                        else:
-                            self._logger.error(
-                                u'{} != {} wtf!?'.format(task.key, task_key))
-
-                        self._workers.free(worker_index)
-                        self._logger.info(
-                            this_msg.task_free.format(
+                queue_items.extend(self._receive())
+                if not self._event_mode:
+                    check_commands = True
+                elif WakeEventEnum.COMMAND in queue_items:
+                    check_commands = True
+
+                for free_task_data in queue_items:
+                    if not isinstance(free_task_data, tuple):
+                        # backend event
+                        continue
+
+                    task_key, worker_index, result = free_task_data
+
+                    task = self._worker_task_data.get(worker_index)
+                    if task is None or task.key != task_key:
+                        # late result of stopped task
+                        self._logger.warning(
+                            this_msg.result_ignored.format(
                                 task_key, worker_index + 1))
-                        del task
+                        if worker_index in self._stopped_threads:
+                            # thread returned, slot is free now
+                            self._stopped_threads.discard(worker_index)
+                            self._workers.free(worker_index)
+                        continue
+
+                    # set result
+                    last_free_indexes.add(worker_index)
+                    del self._worker_task_data[worker_index]
+                    state = self._running.pop(worker_index, None) or {}
+                    if self._prefork and (
+                            self._workers.mode(worker_index) ==
+                            ExecutionModeEnum.PROCESS):
+                        event = self._prefork.done(
+                            worker_index, self._max_memory)
+                        if event:
+                            result.update(events=[event])
+                            self._logger.info(
+                                this_msg.worker_recycled.format(
+                                    worker_index + 1, event))
+
+                    self._finish_task(task, result, worker_index, state)
+                    self._workers.free(worker_index)
+                    self._logger.info(
+                        this_msg.task_free.format(
+                            task_key, worker_index + 1))
+                    del task
+
+                del queue_items[:]
 
                 # fake free
-                free_workers_data = self._task_src.select_manage_command(
-                    ManageCommandEnum.FAKE_FREE_WORKER)
+                free_workers_data = None
+                if check_commands:
+                    check_commands = False
+                    free_workers_data = self._task_src.select_manage_command(
+                        ManageCommandEnum.FAKE_FREE_WORKER)
 
                 if free_workers_data:
 
@@ -198,81 +826,454 @@ class WorkerManager(object):
                             task = self._worker_task_data.get(need_free_index)
 
                             if task:
-                                task.result = dict(
-                                    error=this_msg.fake_worker_free,
-                                    status=TaskResultStatus.FAILED)
-                                task.returned = time.time()
-                                self._task_src.update_task(task)
+                                self._stop_task(
+                                    need_free_index,
+                                    WorkerEventEnum.FREE,
+                                    this_msg.fake_worker_free)
                                 self._logger.warning(
                                     this_msg.fake_end_task.format(
-                                        task.key, need_free_index))
+                                        task.key, need_free_index + 1))
 
+                self._supervise()
+                self._sample()
+                self._heartbeat()
                 self._step()
-                delay_method(self._delay)
+                if self._autoscale and self._scale():
+                    # new workers take tasks now
+                    self._step()
+                if self._event_mode:
+                    # new task or free worker wakes up
+                    queue_items = self._receive(self._wait_time())
+                    # idle, lost wake up message is possible
+                    check_commands = not queue_items
+                else:
+                    delay_method(self._delay)
                 gc.collect()
 
+    def _finish_task(self, task, result, index, state):
+        task.result = result
+        task.returned = time.time()
+        if task.type == TaskTypeEnum.RPC:
+            self._task_src.update_task(task)
+            self._task_src.ack_task(task)
+        if self._spool:
+            self._spool.remove(task.key)
+        self._metrics.task_finished(
+            task,
+            self._workers.mode(index),
+            task.returned - state.get('started', task.returned))
+
+    def _heartbeat(self):
+        """
+        Node stays target of manage commands.
+        """
+        now = time.time()
+        if now - self._node_seen < self.NODE_HEARTBEAT_INTERVAL:
+            return
+
+        self._node_seen = now
+        try:
+            self._task_src.register_node()
+        except Exception as err:
+            self._logger.error(this_msg.heartbeat_error.format(err))
+
+    def _sample(self):
+        """
+        Gauges of metrics and stats file.
+        """
+        now = time.time()
+        if now - self._sampled_at < self._metrics_interval:
+            return
+
+        self._sampled_at = now
+        if not(self._metrics_port or self._stats_file):
+            # nobody reads gauges
+            return
+
+        self._metrics.sample(self._workers, self._task_src)
+        if self._stats_file:
+            try:
+                self._metrics.write(self._stats_file)
+            except (IOError, OSError) as err:
+                self._logger.error(
+                    this_msg.stats_file_error.format(self._stats_file, err))
+
+    def _stop_task(self, index, event, error):
+        """
+        Stop task of worker (SIGTERM, SIGKILL after kill timeout),
+        worker is free now. Thread can not be stopped, task fails
+        now but thread slot is free only when method returns.
+        :param int index: worker index
+        :param str event: reason (WorkerEventEnum)
+        :param str error: task result error
+        """
+        task = self._worker_task_data.pop(index, None)
+        state = self._running.pop(index, None) or {}
+        process = None
+        slot_mode = self._workers.mode(index)
+        if slot_mode == ExecutionModeEnum.COROUTINE:
+            self._coroutines.cancel(index)
+        elif slot_mode == ExecutionModeEnum.THREAD:
+            self._logger.warning(
+                this_msg.thread_not_stopped.format(task, index + 1))
+            self._stopped_threads.add(index)
+        elif self._prefork:
+            process = self._prefork.terminate(index)
+        else:
+            process = state.get('process')
+
+        if process is not None and process.is_alive():
+            process.terminate()
+            self._dying.append(
+                [process, time.time() + self._kill_timeout])
+
+        if task:
+            self._finish_task(
+                task,
+                dict(
+                    error=error,
+                    status=TaskResultStatus.FAILED,
+                    events=[event]),
+                index,
+                state)
+            self._logger.warning(
+                this_msg.task_stopped.format(task.key, index + 1, event))
+
+        if index not in self._stopped_threads:
+            self._workers.free(index)
+
+    def _supervise(self):
+        """
+        Hard timeout and memory limit of running tasks.
+        """
+        self._reap()
+        now = time.time()
+        check_memory = bool(
+            self._memory_limit and
+            now - self._memory_checked >= self.MEMORY_CHECK_INTERVAL)
+        if check_memory:
+            self._memory_checked = now
+
+        for index, state in self._running.items():
+            process = state.get('process')
+            if now >= state.get('deadline'):
+                self._stop_task(
+                    index,
+                    WorkerEventEnum.TIMEOUT,
+                    this_msg.task_timeout.format(state.get('timeout')))
+            elif check_memory and process is not None:
+                rss = process_rss(process.pid)
+                if rss > self._memory_limit:
+                    self._stop_task(
+                        index,
+                        WorkerEventEnum.MEMORY_LIMIT,
+                        this_msg.task_memory_limit.format(
+                            rss // self.MEGABYTE))
+
+    def _reap(self, force=False):
+        """
+        Kill stopped processes after kill timeout.
+        :param bool force: kill all now and wait
+        """
+        now = time.time()
+        dying = []
+        for process, kill_time in self._dying:
+            if not process.is_alive():
+                process.join()
+                continue
+
+            if force or now >= kill_time:
+                try:
+                    os.kill(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            if force:
+                process.join()
+            else:
+                dying.append([process, kill_time])
+        self._dying = dying
+
+    def _load(self):
+        """
+        load average per cpu
+        """
+        try:
+            result = os.getloadavg()[0] / cpu_count()
+        except (OSError, NotImplementedError):
+            result = 0
+        return result
+
+    def _scale(self):
+        """
+        Grow process workers if tasks wait,
+        shrink by one worker after idle time.
+        :rtype: bool
+        :return: workers are added
+        """
+        result = False
+        now = time.time()
+        if now - self._scaled_at < self._scale_interval:
+            return result
+
+        self._scaled_at = now
+        mode = ExecutionModeEnum.PROCESS
+        size = self._workers.size(mode)
+        free = self._workers.count_free(mode)
+        depth, wait = self._task_src.queue_stats()
+        depth = depth or 0
+        backlog = depth > self._scale_up_depth or bool(
+            self._scale_up_wait and wait and wait > self._scale_up_wait)
+
+        if backlog and not free:
+            self._idle_since = None
+            if size < self._max_workers:
+                load = self._load()
+                if self._scale_max_load and load > self._scale_max_load:
+                    self._logger.info(
+                        this_msg.scale_up_blocked.format(size, load, depth))
+                else:
+                    count = min(
+                        self._max_workers - size,
+                        max(depth - self._scale_up_depth, 1))
+                    for _ in xrange(count):
+                        self._workers.add(mode)
+                    result = True
+                    self._metrics.scaled.inc(count, direction='up')
+                    self._logger.info(
+                        this_msg.scale_up.format(
+                            size,
+                            size + count,
+                            depth,
+                            None if wait is None else round(wait, 1),
+                            load))
+
+        elif free and not depth:
+            if self._idle_since is None:
+                self._idle_since = now
+            elif (now - self._idle_since >= self._scale_idle_time and
+                    size > self._min_workers):
+                index = self._workers.remove(mode)
+                if index is not None and self._prefork:
+                    self._prefork.close(index)
+                self._metrics.scaled.inc(direction='down')
+                self._logger.info(
+                    this_msg.scale_down.format(
+                        size, size - 1, int(now - self._idle_since)))
+                self._idle_since = now
+        else:
+            self._idle_since = None
+
+        return result
+
+    def _wait_time(self):
+        """
+        wait timeout, not later than next delayed or periodic task
+        (if any worker is free), task deadline, kill of stopped process,
+        autoscaling, metrics sample or node heartbeat
+        """
+        result = self._wait_timeout
+        wake_times = [
+            state.get('deadline') for state in self._running.values()]
+        wake_times.extend(kill_time for _, kill_time in self._dying)
+        if self._workers.count_free():
+            # busy workers wake loop by results
+            for next_run in (
+                    self._task_src.next_run(),
+                    self._periodic_task_src.next_run()):
+                if next_run is not None:
+                    wake_times.append(next_run)
+        wake_times.append(self._node_seen + self.NODE_HEARTBEAT_INTERVAL)
+        if self._memory_limit and self._running:
+            wake_times.append(
+                self._memory_checked + self.MEMORY_CHECK_INTERVAL)
+        if self._autoscale:
+            wake_times.append(self._scaled_at + self._scale_interval)
+        if self._metrics_port or self._stats_file:
+            wake_times.append(self._sampled_at + self._metrics_interval)
+
+        if wake_times:
+            result = max(
+                min(result, min(wake_times) - time.time()),
+                self.MIN_WAIT_TIME)
+        return result
+
     def stop(self):
         self._is_work = False
 
+    def _free_worker_for(self, mode):
+        """
+        Free worker index for task of this mode (None if no worker).
+        """
+        free_worker_index = self._workers.get_free(mode=mode)
+        if (free_worker_index is None and
+                mode != ExecutionModeEnum.PROCESS):
+            # thread or coroutine task can run in process,
+            # never process task in thread or event loop
+            free_worker_index = self._workers.get_free(
+                mode=ExecutionModeEnum.PROCESS)
+        if (free_worker_index is None and not self._autoscale and
+                not self._workers.size(mode)):
+            # no worker of this mode at all
+            free_worker_index = self._workers.get_free()
+        return free_worker_index
+
     def _step(self):
         count_free_workers = self._workers.count_free()
         logger = self._logger
 
-        if count_free_workers and not self._is_work:
+        count_new = count_free_workers
+        if self._free_on_release is not None:
+            if count_free_workers > self._free_on_release:
+                # worker is free after tasks were returned
+                self._free_on_release = None
+            else:
+                # returned tasks are not claimed again,
+                # process worker runs task of any mode
+                self._free_on_release = count_free_workers
+                count_new = self._workers.count_free(
+                    mode=ExecutionModeEnum.PROCESS)
+
+        tasks = []
+        if count_new > 0 and not self._is_work:
             # wait stopping
             logger.warning(this_msg.ignor_new_tasks)
-        elif count_free_workers:
+        elif count_new > 0:
+            reserved = []
 
-            for _ in xrange(count_free_workers):
-                # periodic task first
-                task = self._periodic_task_src.pop_task()
-                # onece tasks
-                if not task:
-                    task = self._task_src.pop_task()
+            def reserve(task):
+                # periodic run is fired only if it has free worker
+                index = self._free_worker_for(
+                    self._method_modes.get(task.method, task.mode))
+                if index is not None:
+                    self._workers.busy(index)
+                    reserved.append(index)
+                return index is not None
 
-                if task:
-                    free_worker_index = self._workers.get_free()
+            # periodic task first
+            tasks = self._periodic_task_src.pop_tasks(
+                count_new, accept=reserve)
+            for index in reserved:
+                self._workers.free(index)
+            # onece tasks
+            if len(tasks) < count_new:
+                tasks.extend(
+                    self._task_src.pop_tasks(count_new - len(tasks)))
+
+        if tasks:
+            released = []
+            for task in tasks:
+                mode = self._method_modes.get(task.method, task.mode)
+                free_worker_index = self._free_worker_for(mode)
+                if free_worker_index is None:
+                    # other manager can run it
+                    released.append(task)
+                    logger.debug(
+                        this_msg.task_mode_release.format(
+                            task, ExecutionModeEnum.key(mode)))
+                    continue
+                if self._workers.mode(free_worker_index) != mode:
                     logger.debug(
-                        this_msg.selected_task.format(task))
-
-                    if task.method not in self._methods_cache:
-                        try:
-                            # check
-                            task_method = import_object(task.method)
-                        except Exception as err:
-                            logger.debug(err)
-                        else:
-                            if callable(task_method):
-                                self._methods_cache[task.method] = task_method
-
-                    if task.method in self._methods_cache:
+                        this_msg.task_mode_busy.format(
+                            task,
+                            ExecutionModeEnum.key(mode),
+                            free_worker_index + 1))
+                logger.debug(
+                    this_msg.selected_task.format(task))
+
+                try:
+                    method_id = self._registry.get_id(task.method)
+                except ConfigError as err:
+                    logger.debug(err)
+                    method_id = None
+
+                if method_id is not None:
+                    descriptor = {
+                        'task': task.key,
+                        'task_type': task.type,
+                        'method': task.method,
+                        'method_id': method_id,
+                        'params': None,
+                        # delay in backend or in worker
+                        'delay': (
+                            0 if self._task_src.schedules_delay
+                            else task.delay),
+                        'timeout': task.timeout,
+                    }
+                    # params are decoded in worker
+                    params_content = task.params_content
+                    if self._spool and self._spool.need(params_content):
+                        descriptor.update(
+                            params_handle=self._spool.put(
+                                task.key, params_content))
+                    elif params_content:
+                        descriptor.update(params_content=params_content)
+                    else:
+                        descriptor.update(params=task.params)
+                    slot_mode = self._workers.mode(free_worker_index)
+                    # coroutines share event loop, not profiled
+                    if (self._profiler and
+                            slot_mode != ExecutionModeEnum.COROUTINE):
+                        profile_path = self._profiler.need(task.method)
+                        if profile_path:
+                            descriptor.update(profile_path=profile_path)
+                    # wait result here
+                    self._worker_task_data[free_worker_index] = task
+                    self._workers.busy(free_worker_index)
+                    logger.info(
+                        this_msg.started_task.format(
+                            task,
+                            TaskTypeEnum.key(task.type),
+                            free_worker_index + 1))
+
+                    # hard timeout of task
+                    started = time.time()
+                    self._metrics.task_started(task, slot_mode, started)
+                    self._running[free_worker_index] = {
+                        'process': None,
+                        'started': started,
+                        'timeout': task.timeout,
+                        'deadline': (
+                            started + task.timeout +
+                            descriptor.get('delay')),
+                    }
+                    if slot_mode == ExecutionModeEnum.THREAD:
+                        self._threads.send(free_worker_index, descriptor)
+                    elif slot_mode == ExecutionModeEnum.COROUTINE:
+                        self._coroutines.send(free_worker_index, descriptor)
+                    elif self._prefork:
+                        self._prefork.send(free_worker_index, descriptor)
+                        self._running[free_worker_index].update(
+                            process=self._prefork.process(
+                                free_worker_index))
+                    else:
                         # all ok, create process
+                        descriptor.update(
+                            index=free_worker_index,
+                            result_queue=self._result_tasks_queue,
+                            delay_method=self._delay_method_name,
+                            logger_name=logger.name,
+                            registry=self._registry)
                         worker = Process(
                             target=process_worker,
-                            name='worker_{}'.format(free_worker_index + 1),
-                            kwargs={
-                                'index': free_worker_index,
-                                'task': task.key,
-                                'task_type': task.type,
-                                'result_queue': self._result_tasks_queue,
-                                'method': task.method,
-                                'params': task.params,
-                                'delay': task.delay,
-                                'delay_method': self._delay_method_name,
-                                'logger_name': logger.name,
-                                'timeout': task.timeout,
-                            })
-                        # wait result here
-                        self._worker_task_data[free_worker_index] = task
-                        self._workers.busy(free_worker_index)
-                        logger.info(
-                            this_msg.started_task.format(
-                                task,
-                                TaskTypeEnum.key(task.type),
-                                free_worker_index + 1))
+                            name='worker_{}'.format(
+                                free_worker_index + 1),
+                            kwargs=descriptor)
                         worker.start()
-                    else:
-                        logger.error(
-                            this_msg.no_methods.format(task, task.method))
+                        self._running[free_worker_index].update(
+                            process=worker)
                 else:
-                    break
+                    error = this_msg.no_methods.format(task, task.method)
+                    logger.error(error)
+                    if task.type == TaskTypeEnum.RPC:
+                        # never runs on this node, waiters get error
+                        task.result = dict(
+                            error=error,
+                            status=TaskResultStatus.FAILED)
+                        task.returned = time.time()
+                        self._task_src.update_task(task)
+                        self._task_src.ack_task(task)
+
+            if released:
+                self._task_src.release_tasks(released)
+                # not claimed again until any worker is free
+                self._free_on_release = self._workers.count_free()
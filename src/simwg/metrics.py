@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import json
+import os
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+from .task import (
+    ExecutionModeEnum, TaskPriorityEnum, TaskResultStatus, TaskTypeEnum)
+
+"""
+Manager metrics in memory (counters, gauges, histograms),
+exported in Prometheus text format over http and to stats file:
+
+    options.update(metrics_port=9120, stats_file='/tmp/simwg.json')
+
+    curl http://127.0.0.1:9120/metrics
+"""
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 3600.0)
+
+
+def _escape(value):
+    return unicode(value).replace(
+        u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [
+        u'{}="{}"'.format(name, _escape(value))
+        for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return u'{{{}}}'.format(u','.join(pairs)) if pairs else u''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        result = u'+Inf'
+    else:
+        result = repr(float(value))
+    return result
+
+
+class Metric(object):
+
+    kind = None
+
+    _name = None
+    _help = None
+    _labels = None
+    _values = None
+    _lock = None
+
+    def __init__(self, name, help_text, labels=()):
+        self._name = name
+        self._help = help_text
+        self._labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    @property
+    def name(self):
+        return self._name
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self._labels)
+
+    def _header(self):
+        return [
+            u'# HELP {} {}'.format(self._name, self._help),
+            u'# TYPE {} {}'.format(self._name, self.kind)]
+
+    def render(self):
+        """
+        :rtype: list
+        :return: lines of text format
+        """
+        result = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            result.append(u'{}{} {}'.format(
+                self._name,
+                _format_labels(self._labels, key),
+                _format_value(value)))
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            {'labels': dict(zip(self._labels, key)), 'value': value}
+            for key, value in items]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    _buckets = None
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labels)
+        self._buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # bucket counts (not cumulative), sum
+                data = self._values[key] = [[0] * len(self._buckets), 0.0]
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    data[0][index] += 1
+                    break
+            data[1] += value
+
+    def render(self):
+        result = self._header()
+        with self._lock:
+            items = sorted(
+                (key, (list(data[0]), data[1]))
+                for key, data in self._values.items())
+
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                result.append(u'{}_bucket{} {}'.format(
+                    self._name,
+                    _format_labels(
+                        self._labels,
+                        key,
+                        u'le="{}"'.format(_format_value(bound))),
+                    cumulative))
+            labels = _format_labels(self._labels, key)
+            result.append(u'{}_sum{} {}'.format(
+                self._name, labels, _format_value(total)))
+            result.append(u'{}_count{} {}'.format(
+                self._name, labels, cumulative))
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            items = sorted(
+                (key, (list(data[0]), data[1]))
+                for key, data in self._values.items())
+        return [
+            {
+                'labels': dict(zip(self._labels, key)),
+                'count': sum(counts),
+                'sum': total,
+                'buckets': dict(
+                    (_format_value(bound), count)
+                    for bound, count in zip(self._buckets, counts)),
+            }
+            for key, (counts, total) in items]
+
+
+class Metrics(object):
+    """
+    Registry of metrics.
+    """
+
+    _metrics = None
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        """
+        Prometheus text format.
+        :rtype: str
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.append(u'')
+        return u'\n'.join(lines).encode('utf-8')
+
+    def snapshot(self):
+        return dict(
+            (metric.name, metric.snapshot()) for metric in self._metrics)
+
+    def write(self, path):
+        """
+        Write snapshot to json file (replaced at once).
+        """
+        tmp_path = u'{}.tmp'.format(path)
+        with open(tmp_path, 'w') as stats_file:
+            json.dump(
+                {'time': time.time(), 'metrics': self.snapshot()},
+                stats_file)
+        os.rename(tmp_path, path)
+
+
+class ManagerMetrics(Metrics):
+    """
+    Metrics of worker manager dispatch and result paths.
+    """
+
+    def __init__(self):
+        super(ManagerMetrics, self).__init__()
+        self.started = self.counter(
+            'simwg_tasks_started_total',
+            'Tasks sent to workers.',
+            ('method', 'priority', 'mode'))
+        self.finished = self.counter(
+            'simwg_tasks_finished_total',
+            'Tasks with result.',
+            ('method', 'status'))
+        self.events = self.counter(
+            'simwg_task_events_total',
+            'Tasks stopped or workers recycled by manager.',
+            ('event',))
+        self.wait = self.histogram(
+            'simwg_task_wait_seconds',
+            'Time from enqueue to start of task.',
+            ('priority',))
+        self.runtime = self.histogram(
+            'simwg_task_runtime_seconds',
+            'Time from start to result of task.',
+            ('method',))
+        self.busy = self.counter(
+            'simwg_worker_busy_seconds_total',
+            'Time of workers with task.',
+            ('mode',))
+        self.workers = self.gauge(
+            'simwg_workers',
+            'Worker slots.',
+            ('mode', 'state'))
+        self.queue = self.gauge(
+            'simwg_queue_depth',
+            'Tasks ready to run in backend.',
+            ('priority',))
+        self.scaled = self.counter(
+            'simwg_autoscale_total',
+            'Autoscaling decisions.',
+            ('direction',))
+
+    def task_started(self, task, mode, now):
+        priority = TaskPriorityEnum.key(task.priority)
+        self.started.inc(
+            method=task.method,
+            priority=priority,
+            mode=ExecutionModeEnum.key(mode))
+        if task.type == TaskTypeEnum.RPC and task.created:
+            self.wait.observe(
+                max(now - task.created, 0), priority=priority)
+
+    def task_finished(self, task, mode, runtime):
+        result = task.result
+        status = TaskResultStatus.key(result.status) if result else None
+        self.finished.inc(method=task.method, status=status)
+        self.runtime.observe(runtime, method=task.method)
+        self.busy.inc(runtime, mode=ExecutionModeEnum.key(mode))
+        for event in (result.events if result else ()):
+            self.events.inc(event=event)
+
+    def sample(self, workers, task_src):
+        """
+        Gauges of worker pool and backend queue.
+        """
+        for mode in ExecutionModeEnum.values():
+            size = workers.size(mode)
+            free = workers.count_free(mode)
+            name = ExecutionModeEnum.key(mode)
+            self.workers.set(size - free, mode=name, state='busy')
+            self.workers.set(free, mode=name, state='free')
+
+        for priority, count in task_src.queue_depths().items():
+            self.queue.set(
+                count, priority=TaskPriorityEnum.key(priority))
+
+
+class MetricsServer(Thread):
+    """
+    Local http endpoint /metrics.
+    """
+
+    _server = None
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        super(MetricsServer, self).__init__(name='simwg_metrics')
+        self.daemon = True
+        self._server = HTTPServer((host, port), MetricsHandler)
+        self._server.metrics = metrics
+
+    def run(self):
+        self._server.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] in ('/', '/metrics'):
+            content = self.server.metrics.render()
+            self.send_response(200)
+            self.send_header(
+                'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        # no access log in manager output
+        pass
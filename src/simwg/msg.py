@@ -16,3 +16,29 @@ task_delay_wait = u'task:{}=> worker {} waiting {} sec...'
 stopping = u'stop service...'
 fake_worker_free = u'Worker free by manage command.'
 fake_end_task = u'task:{}=> worker {} now fake free'
+wait_mode = u'wait mode: {}'
+wait_event_error = u'wait backend event error: {}'
+heartbeat_error = u'node heartbeat error: {}'
+no_coroutine_support = (
+    u'coroutine workers need asyncio (trollius for python 2)')
+task_mode_busy = u'task:{}=> no free {} worker, run at {} worker'
+task_mode_release = u'task:{}=> no free {} worker, returned to backend'
+registered_methods = u'registered methods: {}'
+task_timeout = u'Task timeout {} sec, worker stopped.'
+task_memory_limit = u'Worker memory {} MB over limit, worker stopped.'
+task_stopped = u'task:{}=> worker {} stopped: {}'
+worker_recycled = u'worker {} recycled: {}'
+thread_not_stopped = (
+    u'task:{}=> worker {} is thread, it will not be stopped, '
+    u'busy until it returns')
+worker_terminated = u'worker terminated by manager'
+result_ignored = u'task:{}=> worker {} result ignored, task stopped'
+scale_up = (
+    u'autoscale: workers {} -> {} '
+    u'(ready tasks: {}, wait: {}, load: {:.2f})')
+scale_up_blocked = (
+    u'autoscale: workers {} not grown, load {:.2f} (ready tasks: {})')
+scale_down = u'autoscale: workers {} -> {} (idle {} sec)'
+metrics_server = u'metrics: http://{}:{}/metrics'
+profile_path = u'task profiles: {}'
+stats_file_error = u'stats file {} error: {}'
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import argparse
+import cProfile
+import os
+import pstats
+import sys
+import tempfile
+import time
+
+"""
+Sampling profiler of tasks:
+
+    options.update(
+        profile_methods={'pkg.module.method': 1},  # each task
+        profile_rate=100)  # 1 of 100 tasks of other methods
+
+Each profiled call writes <method>@<pid>-<time>.prof in profile path,
+parts are merged to <method>.prof when report is printed:
+
+    python -m simwg.profiling --method pkg.module.method --limit 30
+"""
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'simwg_profile')
+PART_SEPARATOR = '@'
+EXTENSION = '.prof'
+
+
+class TaskProfiler(object):
+    """
+    Manager side, selects tasks for profiling.
+    """
+
+    _path = None
+    _methods = None
+    _rate = 0
+    _counts = None
+
+    def __init__(self, path=None, methods=None, rate=0):
+        """
+        :param str path: profile directory
+        :param dict methods: method full path -> profile 1 of N tasks
+        :param int rate: 1 of N tasks of other methods (0 - never)
+        """
+        self._path = path or DEFAULT_PATH
+        self._methods = dict(
+            (method, int(every or 0))
+            for method, every in (methods or {}).iteritems())
+        self._rate = int(rate or 0)
+        self._counts = {}
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+    @property
+    def path(self):
+        return self._path
+
+    def need(self, method):
+        """
+        :param str method: method full path
+        :rtype: str or None
+        :return: profile directory if task will be profiled
+        """
+        every = self._methods.get(method, self._rate)
+        result = None
+        if every > 0:
+            count = self._counts.get(method, 0)
+            self._counts[method] = count + 1
+            if count % every == 0:
+                result = self._path
+        return result
+
+
+def profile_call(path, method, target_method, params):
+    """
+    Call method under cProfile (in worker), stats to part file.
+    """
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(target_method, **params)
+    finally:
+        part_name = u'{}{}{}-{}'.format(
+            method, PART_SEPARATOR, os.getpid(), int(time.time() * 1e6))
+        tmp_file = os.path.join(path, part_name + '.tmp')
+        try:
+            profiler.dump_stats(tmp_file)
+            # merge reads whole files only
+            os.rename(tmp_file, os.path.join(path, part_name + EXTENSION))
+        except (IOError, OSError):
+            # profile is lost, not task
+            pass
+    return result
+
+
+def merge(path=None, method=None):
+    """
+    Merge part files to one file of each method.
+    :param str path: profile directory
+    :param str method: only this method
+    :rtype: dict
+    :return: method -> pstats.Stats
+    """
+    path = path or DEFAULT_PATH
+    files = {}
+    for name in os.listdir(path):
+        if not name.endswith(EXTENSION):
+            continue
+        file_method = name[:-len(EXTENSION)].split(PART_SEPARATOR, 1)[0]
+        if method and file_method != method:
+            continue
+        files.setdefault(file_method, []).append(
+            os.path.join(path, name))
+
+    result = {}
+    for file_method, method_files in files.iteritems():
+        merged_file = os.path.join(path, file_method + EXTENSION)
+        parts = [
+            part_file
+            for part_file in method_files if part_file != merged_file]
+        sources = sorted(method_files)
+        stats = pstats.Stats(sources[0])
+        if len(sources) > 1:
+            stats.add(*sources[1:])
+
+        if parts:
+            stats.dump_stats(merged_file)
+            for part_file in parts:
+                os.remove(part_file)
+        result[file_method] = stats
+    return result
+
+
+def report(path=None, method=None, sort='cumulative', limit=20,
+           stream=None):
+    """
+    Print hot spots of each method.
+    """
+    stream = stream or sys.stdout
+    profiles = merge(path, method)
+    for file_method in sorted(profiles):
+        stats = profiles[file_method]
+        stats.stream = stream
+        stream.write(u'=== {} ===\n'.format(file_method))
+        stats.sort_stats(sort).print_stats(limit)
+    return profiles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=u'Merged profiles of simwg tasks.')
+    parser.add_argument(
+        '--path', default=DEFAULT_PATH, help=u'profile directory')
+    parser.add_argument(
+        '--method', default=None, help=u'method full path')
+    parser.add_argument(
+        '--sort', default='cumulative', help=u'pstats sort key')
+    parser.add_argument(
+        '--limit', default=20, type=int, help=u'lines of each method')
+    args = parser.parse_args(argv)
+
+    if not report(args.path, args.method, args.sort, args.limit):
+        sys.stderr.write(u'No profiles in {}\n'.format(args.path))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+from .exceptions import ConfigError
+from .helpers import import_object
+
+
+def method_path(method):
+    """
+    full path of function (as in task data)
+    """
+    return u'{}.{}'.format(method.__module__, method.__name__)
+
+
+class MethodRegistry(object):
+    """
+    Task methods imported once in manager,
+    workers (forked later) find method by registry id.
+    """
+
+    _ids = None
+    _methods = None
+    _strict = False
+
+    def __init__(self, methods=None):
+        """
+        :param list methods: full paths or functions,
+            only these methods are executed if set
+        """
+        self._ids = {}
+        self._methods = []
+        self._strict = bool(methods)
+        for method in methods or ():
+            self.register(method)
+
+    def __len__(self):
+        return len(self._methods)
+
+    def __contains__(self, path):
+        return path in self._ids
+
+    @property
+    def strict(self):
+        return self._strict
+
+    def register(self, method):
+        """
+        Import and check method.
+        :param method: full path or function
+        :rtype: int
+        :return: registry id
+        """
+        if callable(method):
+            path = method_path(method)
+            target_method = method
+        else:
+            path = method
+            try:
+                target_method = import_object(path)
+            except Exception as err:
+                raise ConfigError(
+                    u'Method {} import error: {}: {}'.format(
+                        path, err.__class__.__name__, err))
+
+        if not callable(target_method):
+            raise ConfigError(
+                u'Method {} not found or not callable'.format(path))
+
+        result = self._ids.get(path)
+        if result is None:
+            result = len(self._methods)
+            self._methods.append(target_method)
+            self._ids[path] = result
+        return result
+
+    def get_id(self, path):
+        """
+        :rtype: int or None
+        """
+        result = self._ids.get(path)
+        if result is None and not self._strict:
+            # methods of tasks without registry, imported once
+            result = self.register(path)
+        return result
+
+    def get(self, method_id):
+        """
+        :rtype: callable or None
+        """
+        if method_id is not None and 0 <= method_id < len(self._methods):
+            result = self._methods[method_id]
+        else:
+            result = None
+        return result
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import base64
+import json
+import cPickle as pickle
+
+from .exceptions import SerializeError
+
+"""
+Stored data format:
+
+    $<tag><payload>
+
+tag is a one letter code of serializer, in upper case
+if binary payload encoded by base64 (for text storage).
+Data without marker is pickle of old versions.
+"""
+
+MARKER = '$'
+
+
+class BaseSerializer(object):
+
+    name = None
+    tag = None
+    binary = False
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class PickleSerializer(BaseSerializer):
+
+    name = 'pickle'
+    tag = 'p'
+    binary = True
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JsonSerializer(BaseSerializer):
+
+    name = 'json'
+    tag = 'j'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackSerializer(BaseSerializer):
+
+    name = 'msgpack'
+    tag = 'm'
+    binary = True
+
+    _msgpack = None
+
+    def __init__(self):
+        # optional dependency
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, obj):
+        return self._msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+
+class Serializer(object):
+    """
+    Tagged serializer, reads data of all formats.
+    """
+
+    DEFAULT = PickleSerializer.name
+
+    _classes = dict(
+        (serializer_cls.name, serializer_cls)
+        for serializer_cls in (
+            PickleSerializer, JsonSerializer, MsgpackSerializer))
+
+    _tags = dict(
+        (serializer_cls.tag, serializer_cls.name)
+        for serializer_cls in _classes.values())
+
+    _instances = {}
+
+    _current = None
+
+    def __init__(self, name=DEFAULT):
+        self._current = self._get(name=name)
+
+    @classmethod
+    def _get(cls, name=None, tag=None):
+        if tag:
+            name = cls._tags.get(tag)
+
+        serializer = cls._instances.get(name)
+        if serializer is None:
+            try:
+                serializer = cls._classes[name]()
+            except KeyError:
+                raise SerializeError(
+                    u'Unknown serializer: {}'.format(name))
+            except ImportError as err:
+                raise SerializeError(
+                    u'Serializer {} unavailable: {}'.format(name, err))
+            cls._instances[name] = serializer
+        return serializer
+
+    @property
+    def name(self):
+        return self._current.name
+
+    def dumps(self, obj):
+        """
+        :rtype: str
+        """
+        return MARKER + self._current.tag + self._current.dumps(obj)
+
+    def dumps_text(self, obj):
+        """
+        ascii safe data for text fields
+        """
+        if self._current.binary:
+            result = (
+                MARKER +
+                self._current.tag.upper() +
+                base64.b64encode(self._current.dumps(obj)))
+        else:
+            result = self.dumps(obj)
+        return result
+
+    def nested(self, data):
+        """
+        Serialized data (of any format) stored inside data
+        of this serializer, text serializer keeps ascii data only:
+        binary payload is encoded by base64, format is not changed.
+        """
+        if self._current.binary or not data:
+            return data
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data[:1] != MARKER:
+            # old format
+            data = MARKER + PickleSerializer.tag + data
+        tag = data[1:2]
+        if not tag.isupper() and self._get(tag=tag).binary:
+            data = MARKER + tag.upper() + base64.b64encode(data[2:])
+        return data
+
+    def loads(self, data):
+        """
+        Load data of any known format.
+        """
+        try:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+
+            if data[:1] == MARKER:
+                tag = data[1:2]
+                payload = data[2:]
+                if tag.isupper():
+                    tag = tag.lower()
+                    payload = base64.b64decode(payload)
+                result = self._get(tag=tag).loads(payload)
+            else:
+                # old format
+                result = pickle.loads(data)
+        except SerializeError:
+            raise
+        except Exception as err:
+            raise SerializeError(
+                u'{}: {}'.format(err.__class__.__name__, err))
+        return result
+
+    def load_file(self, data_file):
+        """
+        Load data from file like object (mmap),
+        pickle is read without copy of all content.
+        """
+        try:
+            header = data_file.read(2)
+            if header == MARKER + PickleSerializer.tag:
+                result = pickle.load(data_file)
+            else:
+                result = self.loads(header + data_file.read())
+        except SerializeError:
+            raise
+        except Exception as err:
+            raise SerializeError(
+                u'{}: {}'.format(err.__class__.__name__, err))
+        return result
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+
+from .serializer import Serializer
+
+
+class ParamsSpool(object):
+    """
+    Node-local files with large task params,
+    manager writes content once, worker maps it read-only.
+    """
+
+    _path = None
+    _threshold = 0
+
+    def __init__(self, path=None, threshold=0):
+        """
+        :param str path: spool directory (/dev/shm by default)
+        :param int threshold: min params content size in bytes
+        """
+        if not path:
+            path = '/dev/shm'
+            if not os.path.isdir(path):
+                path = tempfile.gettempdir()
+
+        self._path = os.path.join(
+            path, 'simwg_spool_{}'.format(os.getpid()))
+        self._threshold = int(threshold or 0)
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+    def _file(self, key):
+        return os.path.join(
+            self._path, hashlib.md5(str(key)).hexdigest())
+
+    def need(self, content):
+        return bool(
+            self._threshold and content and
+            len(content) >= self._threshold)
+
+    def put(self, key, content):
+        """
+        :param key: task key
+        :param str content: serialized params
+        :rtype: str
+        :return: handle for worker
+        """
+        handle = self._file(key)
+        with open(handle, 'wb') as spool_file:
+            spool_file.write(content)
+        return handle
+
+    def remove(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            # small params, not in spool
+            pass
+
+    def clear(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+
+
+def load_params(handle):
+    """
+    Params from spool file (in worker).
+    :param str handle: spool file path
+    :rtype: dict
+    """
+    with open(handle, 'rb') as spool_file:
+        content = mmap.mmap(
+            spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            result = Serializer().load_file(content)
+        finally:
+            content.close()
+    return result
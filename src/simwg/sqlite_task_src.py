@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import os
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from threading import local
+
+from .exceptions import ConfigError, SerializeError
+from .task import TaskData, TaskPriorityEnum
+from .task_src import BaseTaskBackend, WakeEventEnum
+
+"""
+Local queue of one node in SQLite database (WAL journal),
+producers of other processes on this host use the same file:
+
+    options.update(
+        backend_cls='simwg.SqliteTaskBackend',
+        backend={'path': '/var/lib/simwg/tasks.sqlite3'})
+
+Backend options:
+
+    path            database file (required)
+    synchronous     FULL (default) or NORMAL (faster, last commits
+                    can be lost by power failure, not by crash)
+    busy_timeout    seconds to wait lock of other writer
+    purge_interval  seconds between deletes of expired rows
+    wake_interval   seconds between checks of changes by other
+                    processes in wait_event
+"""
+
+
+class SqliteTaskBackend(BaseTaskBackend):
+    """
+    Tasks are rows of simwg_task, pending tasks are in partial
+    index by priority and then by run time (enqueue time + delay).
+    Row expires after task timeout like key of RedisTaskBackend,
+    expired rows are deleted in small batches, free pages are
+    reused by new rows (no VACUUM).
+    """
+
+    can_wait = True
+    schedules_delay = True
+
+    _path = None
+    _synchronous = 'FULL'
+    _busy_timeout = 30.0
+    _purge_interval = 60.0
+    _wake_interval = 0.05
+    # expired rows deleted by one statement
+    _purge_limit = 1000
+    _default_task_timeout = TaskData.DEFAULT_TIMEOUT
+    _local = None
+    _next_run = None
+    _purged = 0
+    _data_version = None
+    _command_id = None
+
+    _schema = (
+        'CREATE TABLE IF NOT EXISTS simwg_task ('
+        'id INTEGER PRIMARY KEY, '
+        'key TEXT NOT NULL UNIQUE, '
+        'pending INTEGER NOT NULL, '
+        'priority INTEGER NOT NULL, '
+        'run_at REAL NOT NULL, '
+        'expire_at REAL NOT NULL, '
+        'content BLOB NOT NULL)',
+        # only pending rows are indexed
+        'CREATE INDEX IF NOT EXISTS simwg_task_claim '
+        'ON simwg_task (priority DESC, run_at) WHERE pending = 1',
+        'CREATE INDEX IF NOT EXISTS simwg_task_run '
+        'ON simwg_task (run_at) WHERE pending = 1',
+        'CREATE INDEX IF NOT EXISTS simwg_task_expire '
+        'ON simwg_task (expire_at)',
+        'CREATE TABLE IF NOT EXISTS simwg_slot ('
+        'name TEXT NOT NULL, '
+        'slot TEXT NOT NULL, '
+        'node TEXT NOT NULL, '
+        'expire_at REAL NOT NULL, '
+        'PRIMARY KEY (name, slot))',
+        'CREATE TABLE IF NOT EXISTS simwg_node ('
+        'node TEXT PRIMARY KEY, '
+        'seen REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS simwg_command ('
+        'id INTEGER PRIMARY KEY, '
+        'node TEXT NOT NULL, '
+        'name TEXT NOT NULL, '
+        'content BLOB NOT NULL, '
+        'expire_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS simwg_command_node '
+        'ON simwg_command (node, name)',
+    )
+
+    _claim_sql = (
+        'SELECT id, key, content FROM simwg_task '
+        'WHERE pending = 1 AND run_at <= ? AND expire_at > ? '
+        'ORDER BY priority DESC, run_at LIMIT ?')
+
+    _ready_sql = (
+        'FROM simwg_task '
+        'WHERE pending = 1 AND run_at <= ? AND expire_at > ?')
+
+    def __init__(self, options):
+        super(SqliteTaskBackend, self).__init__(options)
+        self._path = self._conf.get('path')
+        if not self._path:
+            raise ConfigError(
+                u'No database path in options of {}'.format(
+                    self.__class__.__name__))
+
+        synchronous = str(
+            self._conf.get('synchronous') or self._synchronous).upper()
+        if synchronous not in ('FULL', 'NORMAL', 'EXTRA'):
+            raise ConfigError(
+                u'Wrong synchronous mode: {}'.format(synchronous))
+
+        self._synchronous = synchronous
+        self._busy_timeout = float(
+            self._conf.get('busy_timeout') or self._busy_timeout)
+        self._purge_interval = float(
+            self._conf.get('purge_interval') or self._purge_interval)
+        self._wake_interval = float(
+            self._conf.get('wake_interval') or self._wake_interval)
+        self._local = local()
+
+    def _connect(self):
+        db = sqlite3.connect(
+            self._path,
+            timeout=self._busy_timeout,
+            # transactions are explicit
+            isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous={}'.format(self._synchronous))
+        with self._transaction(db):
+            for statement in self._schema:
+                db.execute(statement)
+        return db
+
+    @property
+    def _db(self):
+        """
+        connection of this thread (new after fork)
+        """
+        state = self._local
+        if getattr(state, 'pid', None) != os.getpid():
+            state.db = self._connect()
+            state.pid = os.getpid()
+        return state.db
+
+    @contextmanager
+    def _transaction(self, db=None):
+        """
+        write transaction, lock is taken at begin
+        """
+        db = db or self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+    def new_task_key(self, **params):
+        priority = params.get('priority')
+        return u'simwg_task_{}_{}'.format(
+            priority or TaskPriorityEnum.NORMAL,
+            self._rand_line)
+
+    def info(self):
+        db = self._db
+        journal_mode, = db.execute('PRAGMA journal_mode').fetchone()
+        return u'\tpath: {}\n\tsqlite: {}\n\tjournal: {}'.format(
+            self._path, sqlite3.sqlite_version, journal_mode)
+
+    def _load(self, key, content):
+        try:
+            task_data = self._serializer.loads(str(content))
+        except SerializeError as err:
+            self._logger.error(u'task {} skipped: {}'.format(key, err))
+            task_data = None
+        else:
+            assert isinstance(task_data, dict)
+        return task_data
+
+    def _purge(self, db, now):
+        """
+        Delete expired rows (limited count at once).
+        """
+        if now - self._purged < self._purge_interval:
+            return
+
+        deleted = db.execute(
+            'DELETE FROM simwg_task WHERE id IN ('
+            'SELECT id FROM simwg_task WHERE expire_at <= ? LIMIT ?)',
+            (now, self._purge_limit)).rowcount
+        if deleted < self._purge_limit:
+            # else more expired rows at next claim
+            self._purged = now
+        db.execute('DELETE FROM simwg_slot WHERE expire_at <= ?', (now,))
+        db.execute(
+            'DELETE FROM simwg_command WHERE expire_at <= ?', (now,))
+        db.execute(
+            'DELETE FROM simwg_node WHERE seen < ?', (now - self.node_ttl,))
+
+    def pop_task(self):
+        tasks = self.pop_tasks(1)
+        return tasks[0] if tasks else None
+
+    def pop_tasks(self, count):
+        result = []
+        operation_time = time.time()
+        with self._transaction() as db:
+            claimed = db.execute(
+                self._claim_sql,
+                (operation_time, operation_time, int(count))).fetchall()
+            if claimed:
+                db.executemany(
+                    'UPDATE simwg_task SET pending = 0 WHERE id = ?',
+                    [(row_id,) for row_id, _, _ in claimed])
+
+            self._next_run, = db.execute(
+                'SELECT MIN(run_at) FROM simwg_task '
+                'WHERE pending = 1 AND run_at > ?',
+                (operation_time,)).fetchone()
+            self._purge(db, operation_time)
+
+        for _, task_key, content in claimed:
+            task_data = self._load(task_key, content)
+            if task_data is None:
+                # error is logged by _load
+                self._fail_task(task_key, u'task content is not readable')
+            else:
+                task_data['taken'] = operation_time
+                result.append(TaskData(key=task_key, **task_data))
+
+        return result
+
+    def _write_task(self, db, task, now):
+        task.encode_params(
+            self._serializer.dumps, self._serializer.nested)
+        timeout = task.timeout or self._default_task_timeout
+        run_at = now + (task.delay or 0) if task.is_pending else now
+        db.execute(
+            'INSERT OR REPLACE INTO simwg_task '
+            '(key, pending, priority, run_at, expire_at, content) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                task.key,
+                int(bool(task.is_pending)),
+                int(task.priority or TaskPriorityEnum.NORMAL),
+                run_at,
+                run_at + timeout,
+                sqlite3.Binary(self._serializer.dumps(task.as_dict())),
+            ))
+
+    def update_task(self, task):
+        assert isinstance(task, TaskData)
+        with self._transaction() as db:
+            self._write_task(db, task, time.time())
+
+    def release_tasks(self, tasks):
+        # content is not changed by claim, order by run_at is kept
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE simwg_task SET pending = 1 WHERE key = ?',
+                [(task.key,) for task in tasks])
+
+    def add_tasks(self, tasks):
+        # one transaction (one sync of journal) for all tasks
+        now = time.time()
+        with self._transaction() as db:
+            for task in tasks:
+                assert isinstance(task, TaskData)
+                if task.key is None:
+                    task.key = self.new_task_key(priority=task.priority)
+                self._write_task(db, task, now)
+
+    def next_run(self):
+        # known after last claim
+        return self._next_run
+
+    def queue_stats(self):
+        now = time.time()
+        count, first = self._db.execute(
+            'SELECT COUNT(*), MIN(run_at) ' + self._ready_sql,
+            (now, now)).fetchone()
+        wait = None
+        if first is not None:
+            wait = max(now - first, 0)
+        return count, wait
+
+    def queue_depths(self):
+        now = time.time()
+        return dict(self._db.execute(
+            'SELECT priority, COUNT(*) ' + self._ready_sql +
+            ' GROUP BY priority',
+            (now, now)).fetchall())
+
+    def claim_slot(self, name, slot, ttl):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                'DELETE FROM simwg_slot '
+                'WHERE name = ? AND slot = ? AND expire_at <= ?',
+                (name, slot, now))
+            try:
+                db.execute(
+                    'INSERT INTO simwg_slot (name, slot, node, expire_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (name, slot, self._node, now + int(ttl)))
+            except sqlite3.IntegrityError:
+                result = False
+            else:
+                result = True
+        return result
+
+    def get_task(self, key):
+        result = None
+        row = self._db.execute(
+            'SELECT content FROM simwg_task '
+            'WHERE key = ? AND expire_at > ?',
+            (key, time.time())).fetchone()
+        if row is not None:
+            task_data = self._load(key, row[0])
+            if task_data is not None:
+                result = TaskData(key=key, **task_data)
+        return result
+
+    @staticmethod
+    def _get_data_version(db):
+        """
+        changed by commits of other connections only
+        """
+        data_version, = db.execute('PRAGMA data_version').fetchone()
+        return data_version
+
+    def wait_result(self, keys, timeout=None):
+        """
+        Tasks are read again only after changes of database
+        by other connections (data_version).
+        """
+        db = self._db
+        result = None
+        last_version = None
+        deadline = None if timeout is None else time.time() + timeout
+        while result is None:
+            data_version = self._get_data_version(db)
+            if data_version != last_version:
+                last_version = data_version
+                for key in keys:
+                    task = self.get_task(key)
+                    if task and task.result:
+                        result = key
+                        break
+
+            if result is None:
+                wait_time = self._wake_interval
+                if deadline is not None:
+                    wait_time = min(wait_time, deadline - time.time())
+                    if wait_time <= 0:
+                        break
+                time.sleep(wait_time)
+        return result
+
+    def wait_event(self, timeout):
+        """
+        Changes of database by other connections
+        (data_version), checked every wake interval.
+        """
+        db = self._db
+        result = set()
+        deadline = time.time() + timeout
+        while not result:
+            data_version = self._get_data_version(db)
+            if self._data_version is None:
+                self._data_version = data_version
+            elif data_version != self._data_version:
+                self._data_version = data_version
+                result.add(WakeEventEnum.TASK)
+                command_id, = db.execute(
+                    'SELECT MAX(id) FROM simwg_command WHERE node = ?',
+                    (self._node,)).fetchone()
+                if command_id != self._command_id:
+                    self._command_id = command_id
+                    result.add(WakeEventEnum.COMMAND)
+
+            wait_time = deadline - time.time()
+            if result or wait_time <= 0:
+                break
+            time.sleep(min(self._wake_interval, wait_time))
+        return list(result)
+
+    def register_node(self):
+        with self._transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO simwg_node (node, seen) '
+                'VALUES (?, ?)',
+                (self._node, time.time()))
+
+    def unregister_node(self):
+        with self._transaction() as db:
+            db.execute(
+                'DELETE FROM simwg_node WHERE node = ?', (self._node,))
+
+    def set_manage_command(self, command, params, node=None):
+        if not(params and isinstance(params, dict)):
+            raise TypeError('params incorrect')
+
+        if command and isinstance(command, basestring):
+            self._check_command_node(command, node)
+            content = sqlite3.Binary(self._serializer.dumps(params))
+            expire_at = time.time() + self._default_task_timeout
+            with self._transaction() as db:
+                if node:
+                    nodes = [node]
+                else:
+                    nodes = [
+                        row[0] for row in db.execute(
+                            'SELECT node FROM simwg_node WHERE seen >= ?',
+                            (time.time() - self.node_ttl,))]
+
+                db.executemany(
+                    'INSERT INTO simwg_command '
+                    '(node, name, content, expire_at) VALUES (?, ?, ?, ?)',
+                    [
+                        (command_node, command, content, expire_at)
+                        for command_node in nodes])
+
+            if not nodes:
+                self._logger.warning(
+                    'No alive manager node for command {}'.format(command))
+        else:
+            raise TypeError('command incorrect')
+        return len(nodes)
+
+    def select_manage_command(self, command):
+        result = {}
+        if command and isinstance(command, basestring):
+            with self._transaction() as db:
+                commands = db.execute(
+                    'SELECT id, content FROM simwg_command '
+                    'WHERE node = ? AND name = ? AND expire_at > ?',
+                    (self._node, command, time.time())).fetchall()
+                db.executemany(
+                    'DELETE FROM simwg_command WHERE id = ?',
+                    [(command_id,) for command_id, _ in commands])
+
+            for command_id, content in commands:
+                try:
+                    result[command_id] = self._serializer.loads(
+                        str(content))
+                except SerializeError:
+                    continue
+        else:
+            raise TypeError('command incorrect')
+        return result
@@ -9,6 +9,7 @@ import logging
 
 from .common import BaseEnum
 from .config import Options
+from .serializer import Serializer
 
 
 class TaskResultStatus(BaseEnum):
@@ -28,20 +29,55 @@ class TaskTypeEnum(BaseEnum):
     PERIODIC = 2
 
 
+class ExecutionModeEnum(BaseEnum):
+    # own process for each task (or prefork process)
+    PROCESS = 0
+    # thread pool of manager
+    THREAD = 1
+    # event loop of manager (asyncio or trollius)
+    COROUTINE = 2
+
+    @classmethod
+    def from_name(cls, name):
+        """
+        :param name: mode name (process, thread, coroutine) or value
+        :rtype: int
+        """
+        if isinstance(name, basestring):
+            result = getattr(cls, name.upper(), None)
+        else:
+            result = name
+        if result not in cls.values():
+            raise ValueError(u'Unknown execution mode: {}'.format(name))
+        return result
+
+
+class WorkerEventEnum(BaseEnum):
+    # task stopped by manager
+    TIMEOUT = 'timeout'
+    MEMORY_LIMIT = 'memory_limit'
+    FREE = 'free_worker'
+    # worker recycled after task
+    MAX_TASKS = 'max_tasks'
+    MAX_MEMORY = 'max_memory'
+
+
 class TaskResult(dict):
 
     def __init__(
             self,
             status=TaskResultStatus.DONE,
             error=None,
-            content=None):
+            content=None,
+            events=None):
 
         assert status in TaskResultStatus.values()
         super(TaskResult, self).__init__()
         self.update(
             status=status,
             error=error,
-            content=content)
+            content=content,
+            events=events)
 
     @property
     def status(self):
@@ -55,6 +91,13 @@ class TaskResult(dict):
     def content(self):
         return self.get('content')
 
+    @property
+    def events(self):
+        """
+        worker events of task (WorkerEventEnum)
+        """
+        return self.get('events') or []
+
 
 class TaskData(object):
 
@@ -67,6 +110,7 @@ class TaskData(object):
 
     _method = None
     _params = None
+    _params_content = None
     _taken = None
     _timeout = None
     _tid = None
@@ -76,6 +120,8 @@ class TaskData(object):
     _priority = None
     _delay = 0
     _task_type = None
+    _mode = ExecutionModeEnum.PROCESS
+    _created = None
 
     def __init__(
             self,
@@ -84,12 +130,15 @@ class TaskData(object):
             method,
             taken=None,
             params=None,
+            params_content=None,
             timeout=DEFAULT_TIMEOUT,
             result=None,
             returned=None,
             priority=TaskPriorityEnum.NORMAL,
             delay=0,
             task_type=TaskTypeEnum.RPC,
+            mode=ExecutionModeEnum.PROCESS,
+            created=None,
             **kwargs):
 
         if isinstance(result, dict):
@@ -101,10 +150,13 @@ class TaskData(object):
         self._method = method
         self._taken = taken
         self._params = params
+        self._params_content = params_content
         self._returned = returned
         self._timeout = timeout
         self._priority = priority
         self._task_type = task_type
+        self._mode = mode or ExecutionModeEnum.PROCESS
+        self._created = created
 
     def __unicode__(self):
         return u"{}:{}".format(self._method, self._key)
@@ -117,6 +169,13 @@ class TaskData(object):
     def key(self):
         return self._key
 
+    @key.setter
+    def key(self, value):
+        # key of new task known after save in some backends
+        self._key = value
+        if self._tid is None:
+            self._tid = value
+
     @property
     def method(self):
         return self._method or ''
@@ -131,8 +190,39 @@ class TaskData(object):
 
     @property
     def params(self):
+        if self._params is None and self._params_content:
+            # decoded only where used
+            self._params = Serializer().loads(self._params_content)
         return self._params
 
+    @property
+    def params_content(self):
+        """
+        serialized params (None if task created with params)
+        """
+        return self._params_content
+
+    def encode_params(self, dumps, nested=None):
+        """
+        Serialize params once, content is kept as is later.
+        :param dumps: serialize method
+        :param nested: converts content (of other format)
+            for storage in task data
+        """
+        if self._params_content is None and self._params is not None:
+            self._params_content = dumps(self._params)
+        if nested and self._params_content:
+            self._params_content = nested(self._params_content)
+        return self._params_content
+
+    @property
+    def taken(self):
+        return self._taken
+
+    @taken.setter
+    def taken(self, value):
+        self._taken = value
+
     @property
     def returned(self):
         return self._returned
@@ -164,6 +254,24 @@ class TaskData(object):
     def priority(self):
         return self._priority
 
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def created(self):
+        """
+        enqueue timestamp (None if unknown)
+        """
+        return self._created
+
+    @property
+    def is_pending(self):
+        """
+        task waits for a worker
+        """
+        return not(self._taken or self._returned or self._result)
+
     def as_dict(self):
         result_dict = {
             'timeout': self._timeout or TaskData.DEFAULT_TIMEOUT,
@@ -172,10 +280,14 @@ class TaskData(object):
             'delay': self._delay,
             'taken': self._taken,
             'returned': self._returned,
-            'params': self._params,
+            'params': (
+                self._params if self._params_content is None else None),
+            'params_content': self._params_content,
             'priority': self._priority,
             'result': None,
             'task_type': self._task_type,
+            'mode': self._mode,
+            'created': self._created,
         }
 
         if self._result:
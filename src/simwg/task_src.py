@@ -5,17 +5,21 @@
 
 '''
 
+import heapq
 import logging
+import os
 import redis
 import time
 import uuid
 import ConfigParser
-import cPickle as pickle
 from abc import ABCMeta
 from datetime import datetime, time as time_cls, timedelta
 from .common import BaseEnum
 from .config import Options
-from .task import TaskData, TaskPriorityEnum, TaskTypeEnum
+from .exceptions import SerializeError
+from .serializer import MARKER
+from .task import (
+    TaskData, TaskPriorityEnum, TaskResultStatus, TaskTypeEnum)
 from .helpers import import_object
 
 
@@ -24,9 +28,18 @@ class ManageCommandEnum(BaseEnum):
     FAKE_FREE_WORKER = 'fakefree'
 
 
+class WakeEventEnum(BaseEnum):
+
+    TASK = 'task'
+    COMMAND = 'command'
+
+
 class TaskBackend(object):
     _conf = None
     _logger = None
+    _serializer = None
+    _poll_delay = None
+    _node = None
     _option_attr = None
     __metaclass__ = ABCMeta
 
@@ -38,6 +51,9 @@ class TaskBackend(object):
         assert isinstance(self._option_attr, basestring)
         self._conf = getattr(options, self._option_attr)
         self._logger = logging.getLogger(options.logger_name)
+        self._serializer = options.serializer
+        self._poll_delay = options.delay
+        self._node = options.node_name
 
 
 class BasePeriodicTaskBackend(TaskBackend):
@@ -48,12 +64,39 @@ class BasePeriodicTaskBackend(TaskBackend):
     def set_main_backend(self, main_backend):
         self._main_backend = main_backend
 
-    def get_tasks(self, at=None, one=False):
+    def get_tasks(self, at=None, one=False, count=None, accept=None):
+        """
+        :param accept: callable(task), run of not accepted task
+            is not fired (due again at next call)
+        """
         raise NotImplementedError()
 
     def pop_task(self):
         raise NotImplementedError()
 
+    def pop_tasks(self, count, accept=None):
+        return self.get_tasks(count=count, accept=accept)
+
+    def next_run(self):
+        """
+        Nearest run time of periodic tasks (if known).
+        :rtype: float or None
+        """
+        return None
+
+    def claim_run(self, method, run_at, period=0):
+        """
+        Only one node of cluster runs method at this time.
+        :param str method: method full path
+        :param datetime run_at: scheduled run time
+        :param int period: period in minutes (0 - once a day)
+        :rtype: bool
+        """
+        return self._main_backend.claim_slot(
+            method,
+            run_at.strftime('%Y%m%d%H%M'),
+            60 * (period or 24 * 60))
+
     def create_task(self, method):
         priority = int(
             self._conf.get('priority') or TaskPriorityEnum.NORMAL)
@@ -75,6 +118,14 @@ class BasePeriodicTaskBackend(TaskBackend):
 
 class BaseTaskBackend(TaskBackend):
     _option_attr = 'task_backend_options'
+    # backend can block in wait_event (else manager polls it)
+    can_wait = False
+    # delayed task is claimed only after delay (else worker waits)
+    schedules_delay = False
+    # node without heartbeat during this time is not a command target
+    node_ttl = 120
+    # commands with meaning in one node only (never sent to all nodes)
+    node_commands = (ManageCommandEnum.FAKE_FREE_WORKER,)
 
     @property
     def _rand_line(self):
@@ -86,26 +137,288 @@ class BaseTaskBackend(TaskBackend):
     def pop_task(self):
         raise NotImplementedError()
 
+    def pop_tasks(self, count):
+        """
+        Claim up to count tasks at once.
+        :param int count: max count of tasks
+        :rtype: list
+        """
+        result = []
+        while len(result) < count:
+            task = self.pop_task()
+            if not task:
+                break
+            result.append(task)
+        return result
+
     def update_task(self, task):
         raise NotImplementedError()
 
-    def set_manage_command(self, command, params):
+    def add_task(self, task):
+        """
+        Save new task.
+        """
+        self.update_task(task)
+
+    def add_tasks(self, tasks):
+        """
+        Save many new tasks,
+        tasks without key get key from backend.
+        :param list tasks: list of TaskData
+        """
+        for task in tasks:
+            if task.key is None:
+                task.key = self.new_task_key(priority=task.priority)
+            self.add_task(task)
+
+    def index_pending(self):
+        """
+        Index pending tasks written by old versions
+        (one-off after upgrade).
+        :rtype: int
+        :return: count of indexed tasks
+        """
+        return 0
+
+    def ack_task(self, task):
+        """
+        Task is finished or dropped by manager
+        (claimed task is not delivered again).
+        :param TaskData task: claimed task
+        """
+        pass
+
+    def _fail_task(self, key, error):
+        """
+        Claimed task can not be read, it is finished with error
+        (waiters of result are not blocked).
+        """
+        self.update_task(TaskData(
+            key=key,
+            tid=key,
+            method=None,
+            result=dict(
+                error=u'{}'.format(error),
+                status=TaskResultStatus.FAILED),
+            returned=time.time()))
+
+    def release_tasks(self, tasks):
+        """
+        Claimed tasks are not started by manager,
+        they are pending again (for any manager).
+        :param list tasks: list of TaskData
+        """
+        for task in tasks:
+            task.taken = None
+            self.update_task(task)
+
+    def claim_slot(self, name, slot, ttl):
+        """
+        Atomic claim of slot (periodic task run) by this node.
+        :param str name: slot group name
+        :param str slot: slot id
+        :param int ttl: keep claim seconds
+        :rtype: bool
+        :return: True if slot is not claimed by other node
+        """
+        return True
+
+    def next_run(self):
+        """
+        Nearest run time of delayed tasks (if known).
+        :rtype: float or None
+        """
+        return None
+
+    def queue_stats(self):
+        """
+        Tasks ready to run (for autoscaling).
+        :rtype: tuple
+        :return: count of tasks and wait time in seconds
+            of first task (None if unknown)
+        """
+        return None, None
+
+    def queue_depths(self):
+        """
+        Tasks ready to run by priority (for metrics).
+        :rtype: dict
+        """
+        return {}
+
+    def get_task(self, key):
+        """
+        :rtype: TaskData or None
+        """
+        raise NotImplementedError()
+
+    def wait_result(self, keys, timeout=None):
+        """
+        Wait any of tasks is finished (polling by default).
+        :param list keys: task keys
+        :param float timeout: max wait in seconds (None - forever)
+        :return: key of finished task or None after timeout
+        """
+        result = None
+        deadline = None if timeout is None else time.time() + timeout
+        while result is None:
+            for key in keys:
+                task = self.get_task(key)
+                if task and task.result:
+                    result = key
+                    break
+            else:
+                if deadline is not None and time.time() >= deadline:
+                    break
+                time.sleep(self._poll_delay)
+        return result
+
+    def register_node(self):
+        """
+        Manager of this node is ready for commands
+        (heartbeat, repeated by manager while it runs).
+        """
+        pass
+
+    def unregister_node(self):
+        pass
+
+    def set_manage_command(self, command, params, node=None):
+        """
+        :param str node: manager node name (all alive nodes if None,
+                         required for commands from node_commands)
+        :rtype: int
+        :return: count of target nodes
+        """
         raise NotImplementedError()
 
+    def _check_command_node(self, command, node):
+        if command in self.node_commands and not node:
+            raise ValueError(
+                'node is required for command {}'.format(command))
+
     def select_manage_command(self, command):
+        """
+        Commands for manager of this node.
+        :rtype: dict
+        """
+        raise NotImplementedError()
+
+    def wait_event(self, timeout):
+        """
+        Block until something happened in backend.
+        :param float timeout: max wait in seconds
+        :rtype: list
+        :return: WakeEventEnum values (empty after timeout)
+        """
         raise NotImplementedError()
 
 
 class RedisTaskBackend(BaseTaskBackend):
+    """
+    Tasks are stored as keys simwg_task_*, pending tasks
+    are indexed in sorted set simwg_pending ordered by priority
+    and then by enqueue time.
+    Delayed tasks wait in sorted set simwg_scheduled by run time,
+    their pending index score is in hash simwg_delayed.
+
+    Pending tasks written by versions without index are claimed
+    after one call of index_pending (simwg.api.index_pending_tasks)
+    when new managers are started.
+    """
+
+    can_wait = True
+    schedules_delay = True
 
     _connection = None
+    _pubsub = None
     _key_prefix = 'simwg_'
     _default_task_timeout = TaskData.DEFAULT_TIMEOUT
+    # priority step in pending index score (more than any timestamp)
+    _priority_weight = 10 ** 10
+    # delayed tasks moved to pending index by one claim
+    _move_limit = 1000
+    _claim_script = None
+    _next_run = None
+    # KEYS[1] - pending index, KEYS[2] - scheduled, KEYS[3] - delayed
+    # ARGV[1] - count, ARGV[2] - now, ARGV[3] - move limit
+    # move due delayed tasks to pending index,
+    # remove head of index and return list of
+    # next delayed run, key, content, key, ...
+    # expired tasks are skipped, task keys are not declared
+    # (one redis instance, not cluster)
+    _claim_script_src = """
+        local due = redis.call(
+            'ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2],
+            'LIMIT', 0, tonumber(ARGV[3]))
+        for _, key in ipairs(due) do
+            local score = redis.call('HGET', KEYS[3], key)
+            redis.call('ZREM', KEYS[2], key)
+            redis.call('HDEL', KEYS[3], key)
+            if score then
+                redis.call('ZADD', KEYS[1], score, key)
+            end
+        end
+
+        local next_run = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+        local result = {next_run[2] or ''}
+        local need = tonumber(ARGV[1])
+        while need > 0 do
+            local head = redis.call('ZRANGE', KEYS[1], 0, need - 1)
+            if #head == 0 then
+                break
+            end
+            redis.call('ZREM', KEYS[1], unpack(head))
+            for _, key in ipairs(head) do
+                local content = redis.call('GET', key)
+                if content then
+                    table.insert(result, key)
+                    table.insert(result, content)
+                    need = need - 1
+                end
+            end
+        end
+        return result
+    """
+
+    # options of backend (not of redis connection)
+    _own_options = ()
 
     def __init__(self, options):
         super(RedisTaskBackend, self).__init__(options)
-        pool = redis.ConnectionPool(**self._conf)
+        pool = redis.ConnectionPool(**dict(
+            (name, value)
+            for name, value in self._conf.iteritems()
+            if name not in self._own_options))
         self._connection = redis.Redis(connection_pool=pool)
+        self._claim_script = self._connection.register_script(
+            self._claim_script_src)
+
+    @property
+    def _pending_key(self):
+        return u'{}pending'.format(self._key_prefix)
+
+    @property
+    def _scheduled_key(self):
+        return u'{}scheduled'.format(self._key_prefix)
+
+    @property
+    def _delayed_key(self):
+        return u'{}delayed'.format(self._key_prefix)
+
+    def _result_key(self, task_key):
+        return u'{}result_{}'.format(self._key_prefix, task_key)
+
+    @property
+    def _wake_channel(self):
+        return u'{}wake'.format(self._key_prefix)
+
+    def _pending_score(self, task, at=None):
+        """
+        less score - earlier claim
+        """
+        priority = int(task.priority or TaskPriorityEnum.NORMAL)
+        return -priority * self._priority_weight + (at or time.time())
 
     def new_task_key(self, **params):
         priority = params.get('priority')
@@ -124,94 +437,695 @@ class RedisTaskBackend(BaseTaskBackend):
         return info
 
     def pop_task(self):
-        result = None
-        task_keys = self._connection.keys(
-            '{}task_*'.format(self._key_prefix))
+        tasks = self.pop_tasks(1)
+        return tasks[0] if tasks else None
+
+    def pop_tasks(self, count):
+        result = []
+        # one round trip, claim is atomic on server side
+        operation_time = time.time()
+        claimed = self._claim_script(
+            keys=[
+                self._pending_key,
+                self._scheduled_key,
+                self._delayed_key],
+            args=[int(count), operation_time, self._move_limit])
+
+        next_run = claimed.pop(0)
+        self._next_run = float(next_run) if next_run else None
+
+        for index in xrange(0, len(claimed), 2):
+            task_key, content = claimed[index:index + 2]
+            try:
+                task_data = self._serializer.loads(content)
+            except SerializeError as err:
+                self._logger.error(
+                    u'task {} skipped: {}'.format(task_key, err))
+                self._fail_task(task_key, err)
+                continue
+            else:
+                assert isinstance(task_data, dict)
+                task_data['taken'] = operation_time
+                result.append(TaskData(
+                    key=task_key,
+                    **task_data))
 
-        if task_keys:
-            operation_time = time.time()
-            for task_key in sorted(task_keys, reverse=True):
-                # lock task
-                try:
-                    task_data = pickle.loads(
-                        self._connection.get(task_key))
-                except pickle.UnpicklingError:
-                    continue
-                else:
-                    assert isinstance(task_data, dict)
-                    task_time = task_data.get('taken')
-                    if task_time:
-                        continue
-                    # try to get this task
-                    task_data['taken'] = operation_time
-                    task_timeout = int(
-                        task_data.get('timeout') or
-                        self._default_task_timeout)
-
-                    self._connection.setex(
-                        task_key,
-                        time=task_timeout,
-                        value=pickle.dumps(task_data))
-                    # reread and check
-                    task_data = pickle.loads(
-                        self._connection.get(task_key))
-
-                    if operation_time == task_data.get('taken'):
-                        result = TaskData(
-                            key=task_key,
-                            **task_data)
-                        break
-                    else:
-                        # ops! other server get him fist
-                        # just try to get next
-                        continue
         return result
 
-    def update_task(self, task):
-        assert isinstance(task, TaskData)
-        task_data = task.as_dict()
-        self._connection.setex(
+    def index_pending(self, batch=1000):
+        result = 0
+        keys = []
+        for key in self._connection.scan_iter(
+                match=u'{}task_*'.format(self._key_prefix), count=batch):
+            keys.append(key)
+            if len(keys) >= batch:
+                result += self._index_old_tasks(keys)
+                del keys[:]
+        if keys:
+            result += self._index_old_tasks(keys)
+        if result:
+            self._connection.publish(self._wake_channel, u'')
+        return result
+
+    def _index_old_tasks(self, keys):
+        """
+        Old versions stored untagged pickle and claimed tasks
+        by taken field (running tasks of this version are skipped).
+        :rtype: int
+        """
+        pipe = self._connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        contents = pipe.execute()
+
+        pipe = self._connection.pipeline()
+        result = 0
+        for key, content in zip(keys, contents):
+            if content is None or content[:1] == MARKER:
+                # expired or written by this version
+                continue
+            try:
+                task_data = self._serializer.loads(content)
+            except SerializeError as err:
+                self._logger.error(
+                    u'task {} not indexed: {}'.format(key, err))
+                continue
+
+            task = TaskData(key=key, **task_data)
+            if task.is_pending:
+                # rewritten in this format, not indexed again
+                self._write_task(pipe, task)
+                result += 1
+        pipe.execute()
+        return result
+
+    def _add_pending(self, pipe, task):
+        pipe.zadd(
+            self._pending_key,
+            {task.key: self._pending_score(task)},
+            nx=True)
+
+    def _add_delayed(self, pipe, task, run_at):
+        # moved to pending index by claim
+        pipe.hset(
+            self._delayed_key,
+            task.key,
+            repr(self._pending_score(task, run_at)))
+        pipe.zadd(self._scheduled_key, {task.key: run_at}, nx=True)
+
+    def _write_task(self, pipe, task):
+        task.encode_params(
+            self._serializer.dumps, self._serializer.nested)
+        pipe.setex(
             task.key,
             time=task.timeout,
-            value=pickle.dumps(task_data))
+            value=self._serializer.dumps(task.as_dict()))
+        if task.is_pending and task.delay:
+            self._add_delayed(pipe, task, time.time() + task.delay)
+        elif task.is_pending:
+            self._add_pending(pipe, task)
+        elif task.result:
+            # notify waiters (wait_result)
+            result_key = self._result_key(task.key)
+            pipe.lpush(result_key, 1)
+            pipe.expire(result_key, task.timeout)
+        return task.is_pending
+
+    def update_task(self, task):
+        assert isinstance(task, TaskData)
+        pipe = self._connection.pipeline()
+        if self._write_task(pipe, task):
+            pipe.publish(self._wake_channel, task.key)
+        pipe.execute()
+
+    def release_tasks(self, tasks):
+        # content is not changed by claim, index again
+        # in order of enqueue time
+        pipe = self._connection.pipeline()
+        for task in tasks:
+            pipe.zadd(
+                self._pending_key,
+                {task.key: self._pending_score(task, task.created)},
+                nx=True)
+        pipe.publish(self._wake_channel, u'')
+        pipe.execute()
+
+    def add_tasks(self, tasks):
+        # one MULTI for all tasks
+        pipe = self._connection.pipeline(transaction=True)
+        is_pending = False
+        for task in tasks:
+            assert isinstance(task, TaskData)
+            if task.key is None:
+                task.key = self.new_task_key(priority=task.priority)
+            is_pending = self._write_task(pipe, task) or is_pending
+
+        if is_pending:
+            pipe.publish(self._wake_channel, u'')
+        pipe.execute()
+
+    def next_run(self):
+        # known after last claim
+        return self._next_run
+
+    def queue_stats(self):
+        now = time.time()
+        pipe = self._connection.pipeline(transaction=False)
+        pipe.zcard(self._pending_key)
+        # due delayed tasks, moved to pending on claim
+        pipe.zcount(self._scheduled_key, '-inf', now)
+        pipe.zrange(self._pending_key, 0, 0, withscores=True)
+        pending, scheduled, first = pipe.execute()
+        wait = None
+        if first:
+            # enqueue time is score without priority part
+            wait = max(now - first[0][1] % self._priority_weight, 0)
+        return pending + scheduled, wait
+
+    def queue_depths(self):
+        priorities = TaskPriorityEnum.values()
+        pipe = self._connection.pipeline(transaction=False)
+        for priority in priorities:
+            # score range of priority in pending index
+            low = -priority * self._priority_weight
+            pipe.zcount(
+                self._pending_key,
+                low,
+                '({}'.format(low + self._priority_weight))
+        return dict(zip(priorities, pipe.execute()))
+
+    def claim_slot(self, name, slot, ttl):
+        return bool(self._connection.set(
+            u'{}slot_{}_{}'.format(self._key_prefix, name, slot),
+            self._node,
+            ex=int(ttl),
+            nx=True))
+
+    def get_task(self, key):
+        result = None
+        content = self._connection.get(key)
+        if content is not None:
+            result = TaskData(
+                key=key,
+                **self._serializer.loads(content))
+        return result
+
+    def wait_result(self, keys, timeout=None):
+        result = None
+        result_keys = dict(
+            (self._result_key(key), key) for key in keys)
+        if timeout is not None and timeout <= 0:
+            # check only, no block
+            pipe = self._connection.pipeline(transaction=False)
+            for result_key in result_keys:
+                pipe.exists(result_key)
+            for result_key, exists in zip(result_keys, pipe.execute()):
+                if exists:
+                    result = result_keys.get(result_key)
+                    break
+        else:
+            # blpop timeout 0 - forever, fractional since redis 6
+            pushed = self._connection.blpop(
+                list(result_keys),
+                timeout=0 if timeout is None else timeout)
+
+            if pushed:
+                result_key, value = pushed
+                # for other waiters of this task
+                self._connection.lpush(result_key, value)
+                result = result_keys.get(result_key)
+        return result
+
+    def wait_event(self, timeout):
+        if self._pubsub is None:
+            self._pubsub = self._connection.pubsub(
+                ignore_subscribe_messages=True)
+            self._pubsub.subscribe(
+                self._wake_channel, self._node_channel(self._node))
+
+        result = set()
+        node_channel = self._node_channel(self._node)
+        message = self._pubsub.get_message(timeout=timeout)
+        while message:
+            if message.get('channel') == node_channel:
+                result.add(WakeEventEnum.COMMAND)
+            else:
+                result.add(WakeEventEnum.TASK)
+            # many new tasks - one event
+            message = self._pubsub.get_message()
+        return list(result)
+
+    @property
+    def _nodes_key(self):
+        return u'{}nodes'.format(self._key_prefix)
+
+    def _node_channel(self, node):
+        return u'{}wake_{}'.format(self._key_prefix, node)
+
+    def _command_key(self, command, node):
+        return u'{}command_{}_{}'.format(self._key_prefix, command, node)
+
+    def register_node(self):
+        # score - last heartbeat
+        self._connection.zadd(self._nodes_key, {self._node: time.time()})
 
-    def set_manage_command(self, command, params):
+    def unregister_node(self):
+        self._connection.zrem(self._nodes_key, self._node)
+
+    def set_manage_command(self, command, params, node=None):
         if not(params and isinstance(params, dict)):
             raise TypeError('params incorrect')
 
         if command and isinstance(command, basestring):
-            new_key = u'{}command_{}_{}'.format(
-                self._key_prefix, command, self._rand_line)
-            self._connection.setex(
-                new_key,
-                time=self._default_task_timeout,
-                value=pickle.dumps(params))
+            self._check_command_node(command, node)
+            if node:
+                nodes = [node]
+            else:
+                pipe = self._connection.pipeline()
+                pipe.zremrangebyscore(
+                    self._nodes_key,
+                    '-inf',
+                    '({}'.format(time.time() - self.node_ttl))
+                pipe.zrange(self._nodes_key, 0, -1)
+                _, nodes = pipe.execute()
+
+            if not nodes:
+                self._logger.warning(
+                    'No alive manager node for command {}'.format(command))
+
+            content = self._serializer.dumps(params)
+            pipe = self._connection.pipeline()
+            for target in nodes:
+                command_key = self._command_key(command, target)
+                pipe.rpush(command_key, content)
+                pipe.expire(command_key, self._default_task_timeout)
+                pipe.publish(self._node_channel(target), command)
+            pipe.execute()
         else:
             raise TypeError('command incorrect')
+        return len(nodes)
 
     def select_manage_command(self, command):
         result = {}
         if command and isinstance(command, basestring):
-            keys = u'{}command_{}_*'.format(self._key_prefix, command)
-            commands = self._connection.keys(keys)
-            if commands:
-                geted = []
-                for command_key in commands:
-                    try:
-                        result[command_key] = pickle.loads(
-                            self._connection.get(command_key))
-                    except pickle.UnpicklingError:
-                        continue
-                    else:
-                        geted.append(command_key)
-
-                self._connection.delete(*geted)
+            command_key = self._command_key(command, self._node)
+            pipe = self._connection.pipeline(transaction=True)
+            pipe.lrange(command_key, 0, -1)
+            pipe.delete(command_key)
+            commands, _ = pipe.execute()
 
+            for index, content in enumerate(commands):
+                try:
+                    result[index] = self._serializer.loads(content)
+                except SerializeError:
+                    continue
         else:
             raise TypeError('command incorrect')
         return result
 
 
+class RedisStreamTaskBackend(RedisTaskBackend):
+    """
+    Pending tasks are entries of streams simwg_stream_<priority>
+    read by consumer group (one for all managers of deployment),
+    manager node is consumer of group. Entry is acknowledged
+    and deleted when manager finished task, entries of dead
+    managers are reclaimed by XAUTOCLAIM (redis 6.2+).
+    Task content, results, delayed tasks and commands are
+    stored as in RedisTaskBackend.
+
+    Backend options (besides redis connection options):
+
+        group             consumer group name
+        reclaim_idle      seconds of entry without manager heartbeat
+                          before other manager takes it
+        reclaim_interval  seconds between reclaims and heartbeats
+                          of own entries
+        claim_block       milliseconds of XREADGROUP BLOCK
+                          if queue is empty (0 - no block)
+
+    In poll mode (wait_mode poll) heartbeats are sent only by claims,
+    reclaim_idle should be more than max task run time.
+    """
+
+    _own_options = (
+        'group', 'reclaim_idle', 'reclaim_interval', 'claim_block')
+
+    _group = 'simwg'
+    _reclaim_idle = 120.0
+    _reclaim_interval = 30.0
+    _claim_block = 0
+    # entries taken by one XAUTOCLAIM
+    _reclaim_limit = 100
+    _streams = None
+    _groups_ready = False
+    # task key: (stream, entry id) of tasks in workers
+    _entries = None
+    _reclaim_cursors = None
+    _reclaimed = 0
+    _kept = 0
+    _move_script = None
+    # KEYS[1] - scheduled, KEYS[2] - delayed (task key: stream),
+    # KEYS[3..] - streams
+    # ARGV[1] - now, ARGV[2] - move limit
+    # add due delayed tasks to streams, return next delayed run
+    _move_script_src = """
+        local streams = {}
+        for index = 3, #KEYS do
+            streams[KEYS[index]] = true
+        end
+
+        local due = redis.call(
+            'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+            'LIMIT', 0, tonumber(ARGV[2]))
+        for _, key in ipairs(due) do
+            local stream = redis.call('HGET', KEYS[2], key)
+            redis.call('ZREM', KEYS[1], key)
+            redis.call('HDEL', KEYS[2], key)
+            if stream and streams[stream] then
+                redis.call('XADD', stream, '*', 'key', key)
+            end
+        end
+
+        local next_run = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+        return next_run[2] or ''
+    """
+
+    def __init__(self, options):
+        super(RedisStreamTaskBackend, self).__init__(options)
+        self._group = self._conf.get('group') or self._group
+        self._reclaim_idle = float(
+            self._conf.get('reclaim_idle') or self._reclaim_idle)
+        self._reclaim_interval = float(
+            self._conf.get('reclaim_interval') or self._reclaim_interval)
+        self._claim_block = int(
+            self._conf.get('claim_block') or self._claim_block)
+        # highest priority first
+        self._streams = [
+            (priority, self._stream_key(priority))
+            for priority in sorted(TaskPriorityEnum.values(), reverse=True)]
+        self._entries = {}
+        self._reclaim_cursors = {}
+        self._move_script = self._connection.register_script(
+            self._move_script_src)
+
+    def _stream_key(self, priority):
+        if priority not in TaskPriorityEnum.values():
+            priority = TaskPriorityEnum.NORMAL
+        return u'{}stream_{}'.format(self._key_prefix, priority)
+
+    @staticmethod
+    def _entry_order(entry_id):
+        return tuple(int(part) for part in entry_id.split('-'))
+
+    def _add_pending(self, pipe, task):
+        pipe.xadd(
+            self._stream_key(int(task.priority or TaskPriorityEnum.NORMAL)),
+            {'key': task.key})
+
+    def _add_delayed(self, pipe, task, run_at):
+        pipe.hset(
+            self._delayed_key,
+            task.key,
+            self._stream_key(int(task.priority or TaskPriorityEnum.NORMAL)))
+        pipe.zadd(self._scheduled_key, {task.key: run_at}, nx=True)
+
+    def info(self):
+        info = super(RedisStreamTaskBackend, self).info()
+        return u'{}\n\tconsumer: {} of group {}'.format(
+            info, self._node, self._group)
+
+    def _ensure_groups(self):
+        if self._groups_ready:
+            return
+
+        for _, stream in self._streams:
+            try:
+                # entries added before group are read too
+                self._connection.xgroup_create(
+                    stream, self._group, id='0', mkstream=True)
+            except redis.ResponseError as err:
+                if 'BUSYGROUP' not in str(err):
+                    raise
+        self._groups_ready = True
+
+    def _keep_alive(self, now):
+        """
+        Reset idle time of own entries (heartbeat),
+        they are not reclaimed by other managers.
+        """
+        if now - self._kept < self._reclaim_interval:
+            return
+
+        self._kept = now
+        entries = {}
+        # copies, manager thread changes them
+        for stream, entry_id in self._entries.values():
+            entries.setdefault(stream, []).append(entry_id)
+
+        if entries:
+            pipe = self._connection.pipeline(transaction=False)
+            for stream, entry_ids in entries.iteritems():
+                pipe.xclaim(
+                    stream,
+                    self._group,
+                    self._node,
+                    0,
+                    entry_ids,
+                    justid=True)
+            pipe.execute()
+
+    def _reclaim(self, now, count):
+        """
+        Take up to count entries of dead managers.
+        :rtype: list
+        """
+        result = []
+        if now - self._reclaimed < self._reclaim_interval:
+            return result
+
+        self._reclaimed = now
+        own_ids = set(entry_id for _, entry_id in self._entries.values())
+        for priority, stream in self._streams:
+            limit = min(count - len(result), self._reclaim_limit)
+            if limit <= 0:
+                # rest of entries at next claim
+                self._reclaimed = 0
+                break
+
+            # no XAUTOCLAIM command in redis client
+            reply = self._connection.execute_command(
+                'XAUTOCLAIM',
+                stream,
+                self._group,
+                self._node,
+                int(self._reclaim_idle * 1000),
+                self._reclaim_cursors.get(stream, '0-0'),
+                'COUNT',
+                limit)
+            # redis 7 adds deleted entries to reply
+            cursor, entries = reply[0], reply[1]
+            self._reclaim_cursors[stream] = cursor
+            for entry in entries:
+                if not(entry and entry[1]) or entry[0] in own_ids:
+                    # deleted entry or task of this manager
+                    continue
+                entry_id, fields = entry
+                values = dict(zip(fields[::2], fields[1::2]))
+                result.append(
+                    (priority, entry_id, stream, values.get('key')))
+            if len(result) >= count:
+                self._reclaimed = 0
+
+        if result:
+            self._logger.warning(
+                u'reclaimed {} tasks of stopped managers'.format(
+                    len(result)))
+        return result
+
+    def _read(self, count):
+        """
+        Up to count new entries for this consumer,
+        stream by stream (highest priority first).
+        :rtype: list
+        """
+        result = []
+        for priority, stream in self._streams:
+            if len(result) >= count:
+                break
+            replies = self._connection.xreadgroup(
+                self._group,
+                self._node,
+                {stream: '>'},
+                count=count - len(result))
+            result.extend(self._read_entries(replies, priority))
+
+        if not result and self._claim_block:
+            priorities = dict(
+                (stream, priority) for priority, stream in self._streams)
+            # first entry of any stream (more if added at once)
+            replies = self._connection.xreadgroup(
+                self._group,
+                self._node,
+                dict((stream, '>') for _, stream in self._streams),
+                count=1,
+                block=self._claim_block)
+            for stream, entries in replies or ():
+                result.extend(self._read_entries(
+                    [(stream, entries)], priorities.get(stream)))
+
+            result.sort(
+                key=lambda entry: (-entry[0], self._entry_order(entry[1])))
+            if len(result) > count:
+                self._release(result[count:])
+                del result[count:]
+        return result
+
+    @staticmethod
+    def _read_entries(replies, priority):
+        return [
+            (priority, entry_id, stream, fields.get('key'))
+            for stream, entries in replies or ()
+            for entry_id, fields in entries]
+
+    def _release(self, entries):
+        """
+        Entries back to end of streams (for other consumers).
+        """
+        pipe = self._connection.pipeline()
+        for _, entry_id, stream, task_key in entries:
+            pipe.xack(stream, self._group, entry_id)
+            pipe.xdel(stream, entry_id)
+            pipe.xadd(stream, {'key': task_key})
+        pipe.execute()
+
+    def pop_tasks(self, count):
+        result = []
+        operation_time = time.time()
+        next_run = self._move_script(
+            keys=[self._scheduled_key, self._delayed_key] + [
+                stream for _, stream in self._streams],
+            args=[operation_time, self._move_limit])
+        self._next_run = float(next_run) if next_run else None
+
+        self._ensure_groups()
+        self._keep_alive(operation_time)
+        # nothing over count is delivered to this consumer
+        claimed = self._reclaim(operation_time, count)
+        if len(claimed) < count:
+            claimed.extend(self._read(count - len(claimed)))
+        if not claimed:
+            return result
+
+        pipe = self._connection.pipeline(transaction=False)
+        for _, _, _, task_key in claimed:
+            pipe.get(task_key)
+        contents = pipe.execute()
+
+        for (_, entry_id, stream, task_key), content in zip(
+                claimed, contents):
+            self._entries[task_key] = (stream, entry_id)
+            task_data = None
+            if content is not None:
+                try:
+                    task_data = self._serializer.loads(content)
+                except SerializeError as err:
+                    self._logger.error(
+                        u'task {} skipped: {}'.format(task_key, err))
+                    self._fail_task(task_key, err)
+                else:
+                    assert isinstance(task_data, dict)
+
+            if task_data is None or task_data.get('result'):
+                # expired, broken or finished (reclaimed after ack)
+                self._ack(task_key)
+            else:
+                task_data['taken'] = operation_time
+                result.append(TaskData(key=task_key, **task_data))
+
+        return result
+
+    def _ack(self, task_key):
+        entry = self._entries.pop(task_key, None)
+        if entry is not None:
+            stream, entry_id = entry
+            pipe = self._connection.pipeline(transaction=False)
+            pipe.xack(stream, self._group, entry_id)
+            # stream length is count of waiting and running tasks
+            pipe.xdel(stream, entry_id)
+            pipe.execute()
+
+    def ack_task(self, task):
+        self._ack(task.key)
+
+    def release_tasks(self, tasks):
+        entries = []
+        for task in tasks:
+            entry = self._entries.pop(task.key, None)
+            if entry is not None:
+                stream, entry_id = entry
+                entries.append((None, entry_id, stream, task.key))
+        if entries:
+            self._release(entries)
+            self._connection.publish(self._wake_channel, u'')
+
+    def wait_event(self, timeout):
+        self._keep_alive(time.time())
+        return super(RedisStreamTaskBackend, self).wait_event(timeout)
+
+    def _stream_depths(self):
+        """
+        Entries not read by group in each stream.
+        :rtype: list
+        """
+        self._ensure_groups()
+        pipe = self._connection.pipeline(transaction=False)
+        for _, stream in self._streams:
+            pipe.xlen(stream)
+            pipe.xinfo_groups(stream)
+        replies = pipe.execute()
+
+        result = []
+        for index, (priority, stream) in enumerate(self._streams):
+            length, groups = replies[index * 2:index * 2 + 2]
+            group = dict(
+                (info.get('name'), info) for info in groups).get(
+                    self._group) or {}
+            result.append((
+                priority,
+                stream,
+                max(length - int(group.get('pending') or 0), 0),
+                group.get('last-delivered-id')))
+        return result
+
+    def queue_stats(self):
+        now = time.time()
+        count = self._connection.zcount(self._scheduled_key, '-inf', now)
+        first = None
+        for _, stream, depth, last_id in self._stream_depths():
+            count += depth
+            if not depth:
+                continue
+            # first entry after last delivered one
+            for entry_id, _ in self._connection.xrange(
+                    stream, min=last_id or '-', count=2):
+                if entry_id != last_id:
+                    # enqueue time is in entry id
+                    added = self._entry_order(entry_id)[0] / 1000.0
+                    first = added if first is None else min(first, added)
+                    break
+
+        wait = None
+        if first is not None:
+            wait = max(now - first, 0)
+        return count, wait
+
+    def queue_depths(self):
+        return dict(
+            (priority, depth)
+            for priority, _, depth, _ in self._stream_depths())
+
+
 class ConfigFilePeriodicTaskBackend(BasePeriodicTaskBackend):
     """
     Configuration file has format:
@@ -225,8 +1139,25 @@ class ConfigFilePeriodicTaskBackend(BasePeriodicTaskBackend):
     once run this procedure at 06:00 every day
     web_project.tools.promo_update=20:00 50
     run procedure every 50 minute after 20:00
+
+    File is parsed again only if changed,
+    next runs are in heap (next run, method).
     """
-    _run_at = {}
+    section = 'everytime'
+    # seconds between file changes checks
+    check_interval = 1.0
+
+    _schedule = None
+    _heap = None
+    _mtime = None
+    _checked = None
+    _loaded = False
+
+    def __init__(self, options):
+        super(ConfigFilePeriodicTaskBackend, self).__init__(options)
+        # method: (start time, period in minutes)
+        self._schedule = {}
+        self._heap = []
 
     def info(self):
         try:
@@ -237,39 +1168,64 @@ class ConfigFilePeriodicTaskBackend(BasePeriodicTaskBackend):
             file_content = 'Error: {}'.format(err)
         return file_content
 
-    def get_tasks(self, at=None, one=False):
-        assert isinstance(self._main_backend, BaseTaskBackend)
-        section = 'everytime'
-        config = ConfigParser.ConfigParser()
-        try:
-            config.read(self._conf['path'])
-        except Exception as err:
-            # fake
-            config = {section: []}
-            self._logger.error(
-                'No backend file for periodic tasks: {}'.format(
-                    err))
+    @staticmethod
+    def _last_run(start_time, period, at):
+        """
+        last run of day at or before 'at' (None if not started)
+        """
+        result = None
+        start_run = datetime.combine(at.date(), start_time)
+        if at >= start_run:
+            if period:
+                passed = int(
+                    (at - start_run).total_seconds() // (60 * period))
+                result = start_run + timedelta(seconds=60 * period * passed)
+            else:
+                result = start_run
+        return result
 
-        if not isinstance(at, datetime):
-            at = self.now()
+    @staticmethod
+    def _next_run(start_time, period, at):
+        """
+        first run after 'at'
+        """
+        start_run = datetime.combine(at.date(), start_time)
+        if at < start_run:
+            result = start_run
+        else:
+            result = None
+            if period:
+                passed = int(
+                    (at - start_run).total_seconds() // (60 * period))
+                result = start_run + timedelta(
+                    seconds=60 * period * (passed + 1))
 
-        tasks = {}
-        result = None
+            if result is None or result.date() != start_run.date():
+                # tomorrow
+                result = start_run + timedelta(days=1)
+        return result
+
+    def _parse(self):
+        path = self._conf['path']
+        config = ConfigParser.ConfigParser()
+        config.read(path)
+
+        schedule = {}
         try:
-            methods = config.options(section)
+            methods = config.options(self.section)
         except Exception as err:
             self._logger.warning(err)
             methods = []
 
         for method in methods:
-            line = config.get(section, method)
+            line = config.get(self.section, method)
             run_at = str(line).split()
             if len(run_at) == 2:
                 time_str, period = run_at
             else:
                 self._logger.warning(
                     'wrong line {}={} in conf: {}'.format(
-                        method, line, self._conf['path']))
+                        method, line, path))
                 continue
 
             try:
@@ -277,63 +1233,122 @@ class ConfigFilePeriodicTaskBackend(BasePeriodicTaskBackend):
             except (TypeError, ValueError):
                 self._logger.warning(
                     'wrong line {}={} in conf: {} period not int'.format(
-                        method, line, self._conf['path']))
+                        method, line, path))
                 continue
 
             if not(0 <= period <= 60):
                 self._logger.warning(
                     'wrong line {}={} in conf: {} period incorrect'.format(
-                        method, line, self._conf['path']))
+                        method, line, path))
                 continue
 
             try:
-                start_run = datetime.combine(
-                    at.date(),
-                    time_cls(*map(int, time_str.split(':'))))
+                start_time = time_cls(*map(int, time_str.split(':')))
             except (TypeError, ValueError):
                 self._logger.warning(
                     'wrong line {}={} in conf: {} time incorrect'.format(
-                        method, line, self._conf['path']))
+                        method, line, path))
                 continue
 
-            last_run = self._run_at.get(method)
+            try:
+                method_func = import_object(method)
+            except Exception:
+                method_func = None
 
-            if period == 0:
-                period = 24 * 60
+            if callable(method_func):
+                schedule[method] = (start_time, period)
+            else:
+                self._logger.warning(
+                    'wrong line {}={} in conf: {} bad method'.format(
+                        method, line, path))
+
+        return schedule
+
+    def _reload(self, at):
+        """
+        Parse file if it changed, rebuild heap.
+        """
+        now = time.time()
+        if self._checked and now - self._checked < self.check_interval:
+            return
 
-            if not last_run:
-                self._run_at[method] = (
-                    start_run - timedelta(seconds=60 * period + 1))
+        self._checked = now
+        try:
+            mtime = os.stat(self._conf['path']).st_mtime
+        except Exception as err:
+            mtime = None
+            if self._mtime is not None or not self._loaded:
+                self._logger.error(
+                    'No backend file for periodic tasks: {}'.format(err))
+
+        if self._loaded and mtime == self._mtime:
+            return
+
+        self._loaded = True
+        self._mtime = mtime
+        schedule = self._parse() if mtime is not None else {}
+        next_runs = dict(
+            (method, next_run) for next_run, method in self._heap)
+        heap = []
+        for method, (start_time, period) in schedule.iteritems():
+            next_run = next_runs.get(method)
+            if next_run is None or self._schedule.get(method) != (
+                    start_time, period):
+                # new method, first run now if day period started
+                next_run = (
+                    self._last_run(start_time, period, at) or
+                    self._next_run(start_time, period, at))
+            heap.append((next_run, method))
+
+        heapq.heapify(heap)
+        self._schedule = schedule
+        self._heap = heap
+
+    def get_tasks(self, at=None, one=False, count=None, accept=None):
+        assert isinstance(self._main_backend, BaseTaskBackend)
+        if not isinstance(at, datetime):
+            at = self.now()
+
+        self._reload(at)
+
+        tasks = []
+        skipped = []
+        heap = self._heap
+        while heap and heap[0][0] <= at:
+            run_at, method = heap[0]
+            start_time, period = self._schedule[method]
+            task = self.create_task(method)
+            if accept and not accept(task):
+                skipped.append(heapq.heappop(heap))
                 continue
 
-            need_run = bool(
-                at >= start_run and
-                at >= last_run + timedelta(seconds=60 * period))
+            heapq.heapreplace(
+                heap, (self._next_run(start_time, period, at), method))
+            if self.claim_run(method, run_at, period):
+                tasks.append(task)
+                if one or (count and len(tasks) >= count):
+                    break
+            else:
+                self._logger.debug(
+                    'periodic {} at {} taken by other node'.format(
+                        method, run_at))
 
-            if need_run and method not in tasks:
-                try:
-                    method_func = import_object(method)
-                except Exception as err:
-                    method_func = None
-
-                if callable(method_func):
-                    new_task = self.create_task(method)
-                    self._run_at[method] = at
-                    if one:
-                        # only one task need
-                        result = new_task
-                        break
-                    else:
-                        tasks[method] = new_task
-                else:
-                    self._logger.warning(
-                        'wrong line {}={} in conf: {} bad method'.format(
-                            method, line, self._conf['path']))
+        for item in skipped:
+            heapq.heappush(heap, item)
 
-        if not one:
-            result = tasks.values()
+        if one:
+            result = tasks[0] if tasks else None
+        else:
+            result = tasks
 
         return result
 
     def pop_task(self):
         return self.get_tasks(one=True)
+
+    def next_run(self):
+        result = None
+        if self._heap:
+            # local time of schedule
+            result = time.mktime(self._heap[0][0].timetuple())
+        return result
@@ -6,44 +6,167 @@
 '''
 
 import logging
+import signal
+
+from functools import partial
 
 from . import msg as this_msg
 from .helpers import import_object
+from .profiling import profile_call
+from .serializer import Serializer
+from .spool import load_params
 from .task import TaskResultStatus, TaskTypeEnum
 
+try:
+    import asyncio
+except ImportError:
+    try:
+        # python 2 backport
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
 
-def process_worker(
+def prepare_task(
+        method,
+        params,
+        logger,
+        timeout,
+        params_content=None,
+        params_handle=None,
+        method_id=None,
+        registry=None):
+    """
+    Target method and its kwargs.
+    :param int method_id: method id in registry
+    :param MethodRegistry registry: methods imported by manager
+    :rtype: tuple
+    """
+    if params_handle:
+        params = load_params(params_handle)
+    elif params_content:
+        params = Serializer().loads(params_content)
+
+    target_method = None
+    if registry is not None:
+        target_method = registry.get(method_id)
+    if target_method is None:
+        # registered after fork of this worker
+        target_method = import_object(method)
+
+    if not isinstance(params, dict):
+        params = {}
+
+    if 'logger' not in params:
+        params.update(logger=logger)
+
+    # runtime limit for you procedure
+    # must implemented inside
+    if 'timeout' not in params:
+        params.update(timeout=timeout)
+
+    return target_method, params
+
+
+def done_result(content):
+    result = dict(
+        error=None,
+        content=None,
+        status=TaskResultStatus.DONE)
+    if isinstance(content, basestring):
+        result.update(content=content)
+    return result
+
+
+def failed_result(err, logger, error_msg):
+    err_msg = u'{}: {}'.format(err.__class__.__name__, err)
+    logger.error(error_msg.format(err_msg))
+    return dict(
+        error=err_msg,
+        content=None,
+        status=TaskResultStatus.FAILED)
+
+
+def coroutine_support():
+    return asyncio is not None
+
+
+def new_event_loop():
+    return asyncio.new_event_loop()
+
+
+def set_event_loop(loop):
+    # current loop of thread for coroutines
+    asyncio.set_event_loop(loop)
+
+
+def run_coroutine(coroutine):
+    """
+    Coroutine method out of manager event loop.
+    """
+    loop = new_event_loop()
+    try:
+        result = loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+    return result
+
+
+def start_coroutine(loop, target_method, params):
+    """
+    Start task method in event loop,
+    not coroutine method runs in executor of loop.
+    :rtype: Future
+    """
+    if asyncio.iscoroutinefunction(target_method):
+        ensure_future = (
+            getattr(asyncio, 'ensure_future', None) or
+            getattr(asyncio, 'async'))
+        result = ensure_future(target_method(**params), loop=loop)
+    else:
+        result = loop.run_in_executor(
+            None, partial(target_method, **params))
+    return result
+
+
+def terminate_handler(signum, frame):
+    # manager stops task (timeout, memory limit)
+    raise SystemExit(this_msg.worker_terminated)
+
+
+def execute_task(
         index,
-        result_queue,
         task,
-        task_type,
         method,
         params,
         delay,
         delay_method,
         logger_name,
-        timeout):
+        timeout,
+        params_content=None,
+        params_handle=None,
+        method_id=None,
+        registry=None,
+        profile_path=None):
     """
+    Call task method in this process.
     :param int index: worker index
     :param str task: task key
-    :param Queue result_queue: result aggregator
     :param str method: method full path
-    :param str delay_method: time delay method full path
     :param dict params: method kwargs
-    :param float params: delay before call method
+    :param float delay: delay before call method
+    :param str delay_method: time delay method full path
     :param str logger_name: used logger name
         (logger used as argument for target method)
     :param float timeout: for target method argument
+    :param str params_content: serialized params
+    :param str params_handle: params spool file
+    :param int method_id: method id in registry
+    :param MethodRegistry registry: methods imported by manager
+    :param str profile_path: profile directory (call with cProfile)
+    :rtype: dict
     """
 
-    result = dict(
-        error=None,
-        content=None,
-        status=TaskResultStatus.DONE)
-
-    if not isinstance(params, dict):
-        params = {}
-
     logger = logging.getLogger(logger_name)
     if delay:
         logger.info(
@@ -53,31 +176,135 @@ def process_worker(
 
     error_msg = this_msg.task_run_error_tpl.format(task, index + 1)
     try:
-        target_method = import_object(method)
+        target_method, params = prepare_task(
+            method,
+            params,
+            logger,
+            timeout,
+            params_content=params_content,
+            params_handle=params_handle,
+            method_id=method_id,
+            registry=registry)
     except Exception as err:
-        err_msg = u'{}: {}'.format(err.__class__.__name__, err)
-        logger.error(error_msg.format(err_msg))
-        result.update(
-            error=err_msg,
-            status=TaskResultStatus.FAILED)
+        result = failed_result(err, logger, error_msg)
     else:
-        if 'logger' not in params:
-            params.update(logger=logger)
-
-        # runtime limit for you procedure
-        # must implemented inside
-        if 'timeout' not in params:
-            params.update(timeout=timeout)
-
         try:
-            content = target_method(**params)
-            if isinstance(content, basestring):
-                result.update(content=content)
+            if profile_path:
+                content = profile_call(
+                    profile_path, method, target_method, params)
+            else:
+                content = target_method(**params)
+            if coroutine_support() and asyncio.iscoroutine(content):
+                content = run_coroutine(content)
+            result = done_result(content)
         except Exception as err:
-            err_msg = u'{}: {}'.format(err.__class__.__name__, err)
-            logger.error(error_msg.format(err_msg))
-            result.update(
-                error=err_msg,
-                status=TaskResultStatus.FAILED)
+            result = failed_result(err, logger, error_msg)
+
+    return result
+
+
+def process_worker(
+        index,
+        result_queue,
+        task,
+        task_type,
+        method,
+        params,
+        delay,
+        delay_method,
+        logger_name,
+        timeout,
+        params_content=None,
+        params_handle=None,
+        method_id=None,
+        registry=None,
+        profile_path=None):
+    """
+    :param int index: worker index
+    :param str task: task key
+    :param Queue result_queue: result aggregator
+    :param str method: method full path
+    :param str delay_method: time delay method full path
+    :param dict params: method kwargs
+    :param float params: delay before call method
+    :param str logger_name: used logger name
+        (logger used as argument for target method)
+    :param float timeout: for target method argument
+    :param str params_content: serialized params
+    :param str params_handle: params spool file
+    :param int method_id: method id in registry
+    :param MethodRegistry registry: methods imported by manager
+        (inherited by fork)
+    :param str profile_path: profile directory (call with cProfile)
+    """
+
+    signal.signal(signal.SIGTERM, terminate_handler)
+    result = execute_task(
+        index=index,
+        task=task,
+        method=method,
+        params=params,
+        delay=delay,
+        delay_method=delay_method,
+        logger_name=logger_name,
+        timeout=timeout,
+        params_content=params_content,
+        params_handle=params_handle,
+        method_id=method_id,
+        registry=registry,
+        profile_path=profile_path)
 
     result_queue.put((task, index, result))
+
+
+def prefork_worker(
+        index,
+        result_queue,
+        task_pipe,
+        delay_method,
+        logger_name,
+        max_tasks=0,
+        registry=None):
+    """
+    Long-lived worker, receives tasks from pipe until None.
+    :param int index: worker index
+    :param Queue result_queue: result aggregator
+    :param Connection task_pipe: task descriptors
+        (process_worker kwargs without common arguments)
+    :param str delay_method: time delay method full path
+    :param str logger_name: used logger name
+    :param int max_tasks: exit after this count of tasks (0 - never)
+    :param MethodRegistry registry: methods imported by manager
+        (inherited by fork)
+    """
+
+    signal.signal(signal.SIGTERM, terminate_handler)
+    done = 0
+    while not(max_tasks and done >= max_tasks):
+        try:
+            descriptor = task_pipe.recv()
+        except EOFError:
+            # manager closed pipe
+            break
+
+        if descriptor is None:
+            break
+
+        task = descriptor.get('task')
+        result = execute_task(
+            index=index,
+            task=task,
+            method=descriptor.get('method'),
+            params=descriptor.get('params'),
+            delay=descriptor.get('delay'),
+            delay_method=delay_method,
+            logger_name=logger_name,
+            timeout=descriptor.get('timeout'),
+            params_content=descriptor.get('params_content'),
+            params_handle=descriptor.get('params_handle'),
+            method_id=descriptor.get('method_id'),
+            registry=registry,
+            profile_path=descriptor.get('profile_path'))
+
+        result_queue.put((task, index, result))
+        done += 1
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+'''
+
+@author: Michael Vorotyntsev
+
+'''
+
+import cPickle as pickle
+import unittest
+
+from simwg.serializer import Serializer
+from simwg.task import TaskData
+
+"""
+Tasks written by producer of one format
+and updated by manager of other format.
+"""
+
+
+class MixedFormatTest(unittest.TestCase):
+
+    params = {'n': 1, 'data': u'данные'}
+
+    def _write(self, serializer, task):
+        task.encode_params(serializer.dumps, serializer.nested)
+        return serializer.dumps(task.as_dict())
+
+    def _read(self, serializer, key, content):
+        return TaskData(key=key, **serializer.loads(content))
+
+    def _check(self, producer, manager):
+        task = TaskData(
+            key='task_1', tid='1', method='pkg.method', params=self.params)
+        content = self._write(producer, task)
+
+        task = self._read(manager, 'task_1', content)
+        task.taken = 1.0
+        # update of claimed task
+        content = self._write(manager, task)
+
+        task = self._read(producer, 'task_1', content)
+        self.assertEqual(task.params, self.params)
+
+    def test_pickle_to_json(self):
+        self._check(Serializer('pickle'), Serializer('json'))
+
+    def test_json_to_pickle(self):
+        self._check(Serializer('json'), Serializer('pickle'))
+
+    def test_old_pickle_to_json(self):
+        serializer = Serializer('json')
+        content = serializer.nested(pickle.dumps(self.params, 2))
+        self.assertEqual(serializer.loads(content), self.params)
+        # ascii only in json data
+        serializer.dumps({'params_content': content}).decode('ascii')
+
+
+if __name__ == '__main__':
+    unittest.main()